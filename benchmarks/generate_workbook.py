@@ -0,0 +1,84 @@
+"""Write synthetic PCC exports with the same "Table 1" layout as the real ones.
+
+    python -m benchmarks.generate_workbook synthetic.xlsx --pharmacies 40 --services 11 --months 36
+"""
+import argparse
+import datetime
+
+import numpy as np
+import pandas as pd
+from openpyxl import Workbook
+
+from service_registry import SERVICES
+
+
+REAL_PHARMACIES = [
+    "JASMI LIMITED FRT03",
+    "REVELSTOKE PHARMACY FE297",
+    "TRINITY PHARMACY FKP10",
+    "WOODBRIDGE PHARMACY FLD83"
+]
+
+
+def pharmacy_names(count):
+    names = REAL_PHARMACIES[:count]
+    for i in range(len(names), count):
+        # Made-up but valid-looking ODS codes: F + 4 alphanumerics
+        code = f"F{chr(65 + i % 26)}{chr(65 + (i // 26) % 26)}{i % 100:02d}"
+        names.append(f"BRANCH {i + 1:03d} PHARMACY {code}")
+    return names
+
+
+def service_labels(count, pharmacy_index):
+    # Registry services first, alternating the P1 label the way branches really report it
+    labels = []
+    for spec in SERVICES:
+        labels.append(spec.aliases[0] if spec.aliases and pharmacy_index % 2 else spec.label)
+    labels = labels[:count]
+    labels.extend(f"Extra Service {n}" for n in range(1, count - len(labels) + 1))
+    return labels
+
+
+def month_labels(count, start=datetime.date(2023, 1, 1)):
+    return pd.date_range(start, periods=count, freq='MS').strftime('%b-%y').tolist()
+
+
+def generate_workbook(path, pharmacies=4, services=11, months=24, seed=0):
+    rng = np.random.default_rng(seed)
+    month_names = month_labels(months)
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Table 1")
+    sheet.append(["Pharmacy Contract Compliance Report"])
+    sheet.append([])
+
+    for i, name in enumerate(pharmacy_names(pharmacies)):
+        # Column B is left empty, as in the real exports, so normalization has to drop it
+        sheet.append([name, None] + month_names + ["Average PCM"])
+        for label in service_labels(services, i):
+            values = rng.poisson(rng.uniform(5, 60), size=months).astype(float)
+            values[rng.random(months) < 0.03] = np.nan
+            if label == "ABPM":
+                values[rng.random(months) < 0.02] = -1
+            average = float(np.nanmean(values)) if not np.isnan(values).all() else None
+            cells = [None if np.isnan(v) else int(v) for v in values]
+            sheet.append([label, None] + cells + [average])
+
+    workbook.save(path)
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write a synthetic PCC export workbook.")
+    parser.add_argument("path", help="output .xlsx path")
+    parser.add_argument("--pharmacies", type=int, default=4)
+    parser.add_argument("--services", type=int, default=11)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+    generate_workbook(args.path, args.pharmacies, args.services, args.months, args.seed)
+    print(args.path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""Time and memory-profile each stage of the dashboard pipeline on synthetic exports.
+
+    python -m benchmarks.run --pharmacies 40 --months 36 --output bench_results.json
+    python -m benchmarks.run --baseline bench_results.json
+
+Results are written as JSON (one entry per stage with timings and peak traced memory) so
+runs from different versions can be compared; --baseline prints the ratio against an
+earlier results file.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+import plotly
+from openpyxl import load_workbook
+
+from benchmarks.generate_workbook import generate_workbook
+from figure_transport import compact_figure_json
+from pcc_anomalies import dataset_anomalies
+from pcc_charts import (
+    compliance_heatmap_figure, pcm_comparison_data, pcm_comparison_figure, pharmacy_trends_figure, service_trend_figure
+)
+from pcc_forecast import dataset_forecast
+from pcc_kpis import compliance_matrix, dataset_kpis
+from pcc_loader import apply_schema, build_dataset, find_header_row, memory_report, normalize_pcc_table, read_pcc_sheet
+from service_registry import SERVICE_ALIASES, SERVICES, build_service_table
+
+
+def measure(func, repeat):
+    # Best-of/median wall time over `repeat` runs, plus peak traced memory of one extra run
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'min_s': min(timings),
+        'median_s': statistics.median(timings),
+        'repeat': repeat,
+        'peak_bytes': peak
+    }
+
+
+def _detect_header(file_bytes):
+    workbook = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        sheet = workbook["Table 1"]
+        sheet.reset_dimensions()
+        return find_header_row(sheet.iter_rows(values_only=True))
+    finally:
+        workbook.close()
+
+
+def _build_figures(dataset, service_table):
+    figures = []
+    for pharmacy in dataset.pharmacies:
+        rows = service_table[service_table['pharmacy'] == pharmacy.code]
+        figures.append(pharmacy_trends_figure(dataset.facts_at(rows['position']), pharmacy.name))
+        for spec in SERVICES:
+            spec_rows = rows[rows['service'] == spec.key]
+            if spec.show_trend and not spec_rows.empty:
+                figures.append(service_trend_figure(dataset.facts_at(spec_rows['position']), spec.label, spec.target))
+    figures.append(compliance_heatmap_figure(compliance_matrix(dataset, service_table[service_table['target'].notna()])))
+    valid_rows, _ = pcm_comparison_data(service_table)
+    figures.append(pcm_comparison_figure(valid_rows, [(spec.key, spec.label, spec.target) for spec in SERVICES]))
+    return figures
+
+
+def run_benchmarks(pharmacies, services, months, repeat, seed=0):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = generate_workbook(os.path.join(tmp, "synthetic.xlsx"), pharmacies, services, months, seed)
+        with open(path, 'rb') as f:
+            file_bytes = f.read()
+
+    raw = read_pcc_sheet(file_bytes)
+    df, service_column, month_names = normalize_pcc_table(raw.copy())
+    dataset = build_dataset(df.copy(), service_column, month_names)
+    service_table = build_service_table(dataset)
+    figures = _build_figures(dataset, service_table)
+    # The month cells as read from the sheet, before apply_schema types them
+    raw_months = raw[month_names]
+
+    stages = {
+        'excel_parse': lambda: read_pcc_sheet(file_bytes),
+        'normalize': lambda: normalize_pcc_table(raw.copy()),
+        'header_detection': lambda: _detect_header(file_bytes),
+        'month_coercion': lambda: apply_schema(raw_months.copy(), month_names),
+        'build_dataset': lambda: build_dataset(df.copy(), service_column, month_names),
+        'service_table': lambda: build_service_table(dataset),
+        # Resolving every pharmacy's services through the compiled alias table, as the app does
+        'service_lookup': lambda: dataset.service_table(SERVICE_ALIASES),
+        'kpis': lambda: dataset_kpis(dataset, list(dataset.fact_blocks)),
+        'forecast': lambda: dataset_forecast(dataset, list(dataset.fact_blocks)),
+        'anomalies': lambda: dataset_anomalies(dataset, service_table),
+        'figure_construction': lambda: _build_figures(dataset, service_table),
+        'figure_serialization': lambda: [compact_figure_json(fig) for fig in figures]
+    }
+
+    results = {name: measure(func, repeat) for name, func in stages.items()}
+    results['service_lookup']['lookups'] = len(service_table)
+    results['figure_serialization']['figures'] = len(figures)
+    results['figure_serialization']['bytes'] = sum(len(compact_figure_json(fig)) for fig in figures)
+
+    return {
+        'config': {'pharmacies': pharmacies, 'services': services, 'months': months, 'seed': seed,
+                   'workbook_bytes': len(file_bytes), 'rows': len(df)},
+        'environment': _environment(),
+        'stages': results,
+        # Bytes per column of the sheet as read and of the typed table
+        'memory': memory_report(raw, df).to_dict('records')
+    }
+
+
+def _environment():
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'pandas': pd.__version__,
+        'plotly': plotly.__version__,
+        'machine': platform.machine()
+    }
+
+
+def print_report(report, baseline=None):
+    print(f"{'stage':<22}{'median ms':>12}{'min ms':>10}{'peak MiB':>10}" + (f"{'vs base':>10}" if baseline else ""))
+    for name, stage in report['stages'].items():
+        line = f"{name:<22}{stage['median_s'] * 1000:>12.2f}{stage['min_s'] * 1000:>10.2f}{stage['peak_bytes'] / 2**20:>10.2f}"
+        base = baseline and baseline['stages'].get(name)
+        if base:
+            line += f"{stage['median_s'] / base['median_s']:>9.2f}x"
+        print(line)
+
+    if 'memory' in report:
+        print(f"\n{'column':<22}{'dtype before':>14}{'KiB before':>12}{'dtype':>10}{'KiB':>10}")
+        for row in report['memory']:
+            print(f"{row['column'][:21]:<22}{row['dtype_before']:>14}{row['bytes_before'] / 1024:>12.1f}"
+                  f"{row['dtype']:>10}{row['bytes'] / 1024:>10.1f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark each stage of the PCC dashboard pipeline.")
+    parser.add_argument("--pharmacies", type=int, default=4)
+    parser.add_argument("--services", type=int, default=11)
+    parser.add_argument("--months", type=int, default=24)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="bench_results.json", help="JSON results file")
+    parser.add_argument("--baseline", help="earlier results file to compare against")
+    args = parser.parse_args(argv)
+
+    report = run_benchmarks(args.pharmacies, args.services, args.months, args.repeat, args.seed)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+    print(f"\nWrote {args.output}")
+
+
+if __name__ == "__main__":
+    main()
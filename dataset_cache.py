@@ -0,0 +1,93 @@
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+
+# Memory budget for built datasets shared by every session of the server process
+MAX_DATASET_BYTES = int(os.environ.get("PCC_DATASET_CACHE_MB", "1024")) * 1024 * 1024
+
+
+def dataset_nbytes(value):
+    # Deep size of the frames a dataset holds (the indexes are small next to them), or of a
+    # frame derived from one
+    if isinstance(value, pd.DataFrame):
+        return int(value.memory_usage(deep=True).sum())
+    return int(value.df.memory_usage(deep=True).sum() + value.facts.memory_usage(deep=True).sum())
+
+
+class DatasetCache:
+    # Process-wide LRU of built PCC datasets keyed by content hash, and of the frames derived
+    # from them keyed by (name, content hash). Every session gets the same
+    # object, so callers must treat it as read-only (pandas copy-on-write keeps derived frames
+    # from writing through). Entries are evicted least recently used first once their total
+    # size passes max_bytes; the newest entry is always kept.
+
+    def __init__(self, max_bytes=MAX_DATASET_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._loading = {}
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def get_or_load(self, key, load):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            # Sessions asking for the same export at once wait for one load instead of each
+            # building their own copy
+            key_lock = self._loading.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is not None:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[0]
+
+            try:
+                dataset = load()
+                with self._lock:
+                    self.misses += 1
+                    self._entries[key] = (dataset, dataset_nbytes(dataset))
+                    self._evict()
+            finally:
+                with self._lock:
+                    self._loading.pop(key, None)
+            return dataset
+
+    def _evict(self):
+        total = sum(size for _, size in self._entries.values())
+        while total > self.max_bytes and len(self._entries) > 1:
+            _, (_, size) = self._entries.popitem(last=False)
+            total -= size
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'entries': len(self._entries),
+                'bytes': sum(size for _, size in self._entries.values()),
+                'max_bytes': self.max_bytes
+            }
@@ -0,0 +1,177 @@
+import contextlib
+import itertools
+import os
+import sqlite3
+
+import pandas as pd
+
+from pcc_loader import strip_dedup_suffix
+from pcc_merge import table_period
+from service_registry import SERVICE_ALIASES
+from snapshot_store import SNAPSHOT_DIR
+
+
+# Long-format facts from every upload accumulate in one SQLite file, so history can be queried
+# across exports without loading it all into memory
+FACT_DB = os.environ.get("PCC_FACT_DB", os.path.join(os.path.dirname(SNAPSHOT_DIR), "facts.sqlite"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pharmacies (
+    code TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS services (
+    key TEXT PRIMARY KEY,
+    label TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS facts (
+    pharmacy TEXT NOT NULL,
+    service TEXT NOT NULL,
+    month TEXT NOT NULL,
+    value REAL NOT NULL,
+    -- Last month of the export the value came from
+    period TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (pharmacy, service, month)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS facts_service_month ON facts (service, month);
+CREATE TABLE IF NOT EXISTS ingested (
+    file_hash TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS service_aliases (
+    alias TEXT PRIMARY KEY,
+    service TEXT NOT NULL,
+    rank INTEGER NOT NULL
+) WITHOUT ROWID;
+"""
+
+
+def _in_clause(column, values):
+    return f"{column} IN ({', '.join('?' * len(values))})", list(values)
+
+
+class FactStore:
+    # (pharmacy, service, month) -> value, keyed and clustered on that triple. Services are
+    # stored under their normalized sheet label, months as ISO dates so ranges compare as text.
+    # Queries name a canonical service and reach its labels through the service_aliases table,
+    # rewritten from the registry's compiled aliases whenever a store is opened.
+
+    def __init__(self, path=None, aliases=SERVICE_ALIASES):
+        self.path = path or FACT_DB
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with self._connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+            if 'period' not in {row[1] for row in db.execute("PRAGMA table_info(facts)")}:
+                # Stores written before periods were recorded; their values yield to any export
+                db.execute("ALTER TABLE facts ADD COLUMN period TEXT NOT NULL DEFAULT ''")
+            db.execute("DELETE FROM service_aliases")
+            db.executemany(
+                "INSERT INTO service_aliases (alias, service, rank) VALUES (?, ?, ?)",
+                zip(aliases.index, aliases['service'], aliases['rank'].astype(int).tolist())
+            )
+
+    @contextlib.contextmanager
+    def _connect(self):
+        # One short-lived connection per call, so the store can be shared across threads
+        db = sqlite3.connect(self.path, timeout=30)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def ingest(self, dataset):
+        # Upsert every non-blank fact of the dataset. As in merge_pcc_tables, a value is only
+        # overwritten by an export covering the same or a later period, whatever the upload
+        # order. Returns False when this dataset was already ingested
+        with self._connect() as db:
+            if dataset.file_hash is not None and db.execute(
+                "SELECT 1 FROM ingested WHERE file_hash = ?", (dataset.file_hash,)
+            ).fetchone():
+                return False
+
+            facts = dataset.facts[dataset.facts['Value'].notna()]
+            keys = facts['service_key'].map(strip_dedup_suffix)
+            months = facts['Month_dt'].dt.strftime('%Y-%m-%d')
+            period = table_period((None, None, dataset.months)).strftime('%Y-%m-%d')
+
+            db.executemany(
+                "INSERT INTO pharmacies (code, name) VALUES (?, ?) ON CONFLICT (code) DO UPDATE SET name = excluded.name",
+                [(pharmacy.code, pharmacy.name) for pharmacy in dataset.pharmacies]
+            )
+            db.executemany(
+                "INSERT OR IGNORE INTO services (key, label) VALUES (?, ?)",
+                set(zip(keys, facts['Service']))
+            )
+            db.executemany(
+                "INSERT INTO facts (pharmacy, service, month, value, period) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (pharmacy, service, month) DO UPDATE SET value = excluded.value, period = excluded.period "
+                "WHERE excluded.period >= facts.period",
+                zip(facts['pharmacy'], keys, months, facts['Value'].astype(float), itertools.repeat(period))
+            )
+            if dataset.file_hash is not None:
+                db.execute("INSERT INTO ingested (file_hash) VALUES (?)", (dataset.file_hash,))
+        return True
+
+    def _resolved(self, service, pharmacies=None, start=None, end=None):
+        # Subquery of (pharmacy, month, value) for one canonical service, joined to the facts
+        # of all its labels. Where a pharmacy has several in the same month the preferred label
+        # wins, as in the service table; SQLite takes the bare value from the row holding
+        # MIN(rank). CROSS JOIN keeps the few alias rows as the outer loop, so the facts are
+        # reached through their (service, month) index rather than scanned
+        clauses = ["a.service = ?"]
+        params = [service]
+        if pharmacies:
+            clause, values = _in_clause("f.pharmacy", pharmacies)
+            clauses.append(clause)
+            params.extend(values)
+        if start is not None:
+            clauses.append("f.month >= ?")
+            params.append(pd.Timestamp(start).strftime('%Y-%m-%d'))
+        if end is not None:
+            clauses.append("f.month <= ?")
+            params.append(pd.Timestamp(end).strftime('%Y-%m-%d'))
+
+        query = (
+            "SELECT f.pharmacy, f.month, f.value, MIN(a.rank) AS rank "
+            "FROM service_aliases a CROSS JOIN facts f ON f.service = a.alias "
+            f"WHERE {' AND '.join(clauses)} GROUP BY f.pharmacy, f.month"
+        )
+        return query, params
+
+    def months(self):
+        with self._connect() as db:
+            rows = db.execute("SELECT DISTINCT month FROM facts ORDER BY month").fetchall()
+        return pd.to_datetime([month for month, in rows])
+
+    def pharmacies(self):
+        with self._connect() as db:
+            return pd.read_sql_query("SELECT code, name FROM pharmacies ORDER BY name", db)
+
+    def series(self, service, pharmacies=None, start=None, end=None):
+        # Monthly values per pharmacy for one canonical service, filtered in SQL
+        resolved, params = self._resolved(service, pharmacies, start, end)
+        query = (
+            "SELECT p.name AS pharmacy_name, f.pharmacy, f.month AS Month_dt, f.value AS Value "
+            f"FROM ({resolved}) f JOIN pharmacies p ON p.code = f.pharmacy ORDER BY p.name, f.month"
+        )
+        with self._connect() as db:
+            return pd.read_sql_query(query, db, params=params, parse_dates=['Month_dt'])
+
+    def summary(self, service, pharmacies=None, start=None, end=None):
+        # Per-pharmacy aggregates over the filtered months, computed by SQLite
+        resolved, params = self._resolved(service, pharmacies, start, end)
+        query = (
+            "SELECT p.name AS pharmacy_name, COUNT(*) AS months, SUM(f.value) AS total, AVG(f.value) AS average, "
+            "MIN(f.value) AS minimum, MAX(f.value) AS maximum, MIN(f.month) AS first_month, MAX(f.month) AS last_month "
+            f"FROM ({resolved}) f JOIN pharmacies p ON p.code = f.pharmacy GROUP BY f.pharmacy ORDER BY average DESC"
+        )
+        with self._connect() as db:
+            return pd.read_sql_query(query, db, params=params)
+
+    def stats(self):
+        with self._connect() as db:
+            facts, pharmacies, uploads = db.execute(
+                "SELECT (SELECT COUNT(*) FROM facts), (SELECT COUNT(*) FROM pharmacies), (SELECT COUNT(*) FROM ingested)"
+            ).fetchone()
+        return {'facts': facts, 'pharmacies': pharmacies, 'uploads': uploads, 'bytes': os.path.getsize(self.path)}
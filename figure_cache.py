@@ -0,0 +1,55 @@
+import json
+import threading
+from collections import OrderedDict
+
+
+class FigureCache:
+    # Process-wide LRU of serialized Plotly figures. Keys are
+    # (dataset hash, service, pharmacy, chart type, target) so a figure is only rebuilt when
+    # the data or the selection behind it changes. serialize turns a built figure into the
+    # JSON string that is stored.
+
+    def __init__(self, max_entries=256, serialize=None):
+        self.max_entries = max_entries
+        self.serialize = serialize or (lambda fig: fig.to_json())
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_build(self, key, build):
+        with self._lock:
+            figure_json = self._entries.get(key)
+            if figure_json is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+
+        if figure_json is None:
+            figure_json = self.serialize(build())
+            with self._lock:
+                self.misses += 1
+                self._entries[key] = figure_json
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+
+        # A fresh dict each time, so callers can never mutate the cached figure
+        return json.loads(figure_json)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': sum(len(figure_json) for figure_json in self._entries.values())
+            }
@@ -0,0 +1,56 @@
+import base64
+import json
+import numbers
+
+import numpy as np
+
+
+# Trace attributes holding per-point numbers or dates that are worth packing
+ARRAY_ATTRIBUTES = ('x', 'y', 'z', 'customdata')
+
+MIDNIGHT_SUFFIX = "T00:00:00"
+
+
+def _typed_array(values):
+    # Plotly's binary array encoding: base64 of the raw little-endian buffer plus its dtype
+    array = np.asarray(values)
+    if array.dtype.kind in 'iu' and array.size and np.abs(array).max() < 2**31:
+        array = array.astype('<i4')
+        dtype = 'i4'
+    else:
+        array = array.astype('<f8')
+        dtype = 'f8'
+    spec = {'dtype': dtype, 'bdata': base64.b64encode(array.tobytes()).decode('ascii')}
+    if array.ndim > 1:
+        spec['shape'] = ','.join(str(n) for n in array.shape)
+    return spec
+
+
+def _is_numeric_list(values):
+    return bool(values) and all(
+        isinstance(v, numbers.Number) and not isinstance(v, bool) for v in values
+    )
+
+
+def _pack(values):
+    # Numeric lists become typed arrays; midnight timestamps lose their redundant time part
+    if not isinstance(values, list):
+        return values
+    if _is_numeric_list(values):
+        return _typed_array(values)
+    if all(isinstance(v, str) and v.endswith(MIDNIGHT_SUFFIX) for v in values):
+        return [v[:-len(MIDNIGHT_SUFFIX)] for v in values]
+    return values
+
+
+def compact_figure_json(fig):
+    # Serialize a figure for st.plotly_chart with as few bytes as possible. The layout template
+    # is dropped because Streamlit applies its own theme in the browser, and numbers that plotly
+    # left as JSON lists are sent in its binary typed-array encoding
+    figure = json.loads(fig.to_json())
+    figure['layout']['template'] = {}
+    for trace in figure['data']:
+        for attribute in ARRAY_ATTRIBUTES:
+            if attribute in trace:
+                trace[attribute] = _pack(trace[attribute])
+    return json.dumps(figure, separators=(',', ':'))
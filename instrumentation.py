@@ -0,0 +1,111 @@
+import contextlib
+import json
+import logging
+import threading
+import time
+import tracemalloc
+
+
+logger = logging.getLogger("pharmacy_dashboard.perf")
+if not logger.handlers:
+    _handler = logging.StreamHandler()
+    _handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.addHandler(_handler)
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+# tracemalloc is process-wide while reruns of several sessions overlap: it runs while any
+# enabled instance is active and is stopped by the last one out, unless something else had
+# already started it
+_tracing_lock = threading.Lock()
+_tracing_users = 0
+_tracing_started = False
+
+
+def _acquire_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        if _tracing_users == 0 and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _tracing_started = True
+        _tracing_users += 1
+
+
+def _release_tracing():
+    global _tracing_users, _tracing_started
+    with _tracing_lock:
+        _tracing_users -= 1
+        if _tracing_users == 0 and _tracing_started:
+            tracemalloc.stop()
+            _tracing_started = False
+
+
+class Instrumentation:
+    # Opt-in per-rerun timings and tracemalloc deltas for named stages. Stages may nest; a
+    # parent's peak includes its children's. When disabled, stage() costs one branch. Peaks
+    # are process-wide, so reruns of other sessions running at the same time show up in them.
+
+    def __init__(self, enabled=False, session=None):
+        self.enabled = enabled
+        self.session = session
+        self.records = []
+        self._stack = []
+        self._total_ms = None
+        self._started = time.perf_counter()
+        if enabled:
+            _acquire_tracing()
+
+    @contextlib.contextmanager
+    def stage(self, name, **fields):
+        if not self.enabled:
+            yield
+            return
+
+        current, peak = tracemalloc.get_traced_memory()
+        if self._stack:
+            self._stack[-1]['peak'] = max(self._stack[-1]['peak'], peak)
+        tracemalloc.reset_peak()
+        frame = {'start_memory': current, 'peak': current, 'counters': {}}
+        self._stack.append(frame)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            current, peak = tracemalloc.get_traced_memory()
+            frame_peak = max(frame['peak'], peak)
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1]['peak'] = max(self._stack[-1]['peak'], frame_peak)
+            tracemalloc.reset_peak()
+
+            record = {
+                'stage': name,
+                'depth': len(self._stack),
+                'ms': round(elapsed * 1000, 2),
+                'alloc_kb': round((current - frame['start_memory']) / 1024, 1),
+                'peak_kb': round((frame_peak - frame['start_memory']) / 1024, 1),
+                **frame['counters'],
+                **fields
+            }
+            self.records.append(record)
+            self._log('stage', **record)
+
+    def count(self, name, amount):
+        # Add to a counter on every open stage, so a section reports the total of its children
+        for frame in self._stack:
+            frame['counters'][name] = frame['counters'].get(name, 0) + amount
+
+    def finish(self):
+        # Log the whole rerun and release tracemalloc. Safe to call again, e.g. from a finally
+        # block after the panel has already finished the rerun
+        if not self.enabled:
+            return None
+        if self._total_ms is None:
+            self._total_ms = round((time.perf_counter() - self._started) * 1000, 2)
+            self._log('rerun', total_ms=self._total_ms, stages=len(self.records))
+            _release_tracing()
+        return self._total_ms
+
+    def _log(self, event, **fields):
+        logger.info(json.dumps({'ts': round(time.time(), 3), 'event': event, 'session': self.session, **fields}))
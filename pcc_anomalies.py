@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+from pcc_kpis import value_matrix
+
+
+# Robust z-scores beyond this are flagged (Iglewicz and Hoaglin's usual cut-off)
+ROBUST_Z_LIMIT = 3.5
+
+# Month-over-month changes smaller than this many items are never flagged as jumps, so
+# low-volume services do not flag every wobble
+MIN_JUMP = 10
+
+KIND_ORDER = {'negative': 0, 'outlier': 1, 'drop': 2, 'jump': 3}
+
+ANOMALY_COLUMNS = ['position', 'pharmacy', 'pharmacy_name', 'service', 'label', 'Month_dt', 'value', 'kind', 'score']
+
+
+def _nanmedian(values):
+    # Row medians that are NaN, without a warning, for rows with no observed months
+    result = np.full(len(values), np.nan)
+    observed = ~np.isnan(values).all(axis=1)
+    if observed.any():
+        result[observed] = np.nanmedian(values[observed], axis=1)
+    return result
+
+
+def robust_z(values):
+    # 0.6745 * (x - median) / MAD per row. Where more than half the values equal the median the
+    # MAD is zero, and the mean absolute deviation (scaled by 1.2533) is used instead; NaN
+    # where a row has no spread at all
+    median = _nanmedian(values)
+    deviation = np.abs(values - median[:, None])
+    mad = _nanmedian(deviation)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_ad = np.nanmean(np.where(np.isnan(deviation).all(axis=1)[:, None], 0, deviation), axis=1)
+        scale = np.where(mad > 0, mad / 0.6745, mean_ad * 1.2533)
+        return np.where(scale[:, None] > 0, (values - median[:, None]) / scale[:, None], np.nan)
+
+
+def _previous_observed(values):
+    # For every month, the column of the last observed month before it in the same row (-1 if
+    # none)
+    n = values.shape[1]
+    index = np.where(~np.isnan(values), np.arange(n), -1)
+    previous = np.full(values.shape, -1)
+    previous[:, 1:] = np.maximum.accumulate(index, axis=1)[:, :-1]
+    return previous
+
+
+def detect_anomalies(values):
+    # Flags for a chronological (series, month) matrix, computed for every series at once:
+    # negative counts, level outliers by robust z-score, and month-over-month jumps whose size
+    # is an outlier among that series' own changes. Returns kind and score matrices ('' and
+    # NaN where nothing is flagged); negatives take precedence over outliers over jumps
+    observed = ~np.isnan(values)
+    z = robust_z(values)
+
+    outlier = observed & (np.abs(z) > ROBUST_Z_LIMIT)
+
+    # A change is measured from the previous observed month; the return from an outlier to
+    # normal is not flagged again as a jump
+    previous = _previous_observed(values)
+    has_previous = previous >= 0
+    rows = np.arange(len(values))[:, None]
+    change = np.where(has_previous, values - values[rows, np.maximum(previous, 0)], np.nan)
+    after_outlier = has_previous & outlier[rows, np.maximum(previous, 0)]
+    change_z = robust_z(change)
+    jump = observed & ~after_outlier & (np.abs(change_z) > ROBUST_Z_LIMIT) & (np.abs(change) >= MIN_JUMP)
+    negative = observed & (values < 0)
+
+    kind = np.full(values.shape, '', dtype=object)
+    score = np.full(values.shape, np.nan)
+    kind[jump] = np.where(change[jump] < 0, 'drop', 'jump')
+    score[jump] = change_z[jump]
+    kind[outlier] = 'outlier'
+    score[outlier] = z[outlier]
+    kind[negative] = 'negative'
+    score[negative] = values[negative]
+    return kind, score
+
+
+def dataset_anomalies(dataset, rows):
+    # One row per flagged point of the service table rows given, by kind and then most extreme
+    # first
+    months = dataset.facts['Month_dt'].iloc[:len(dataset.months)].to_numpy()
+    values = value_matrix(dataset, rows['position'])
+    kind, score = detect_anomalies(values)
+
+    series, month = (kind != '').nonzero()
+    flagged = pd.DataFrame({
+        'position': rows['position'].to_numpy()[series],
+        'pharmacy': rows['pharmacy'].to_numpy(dtype=object)[series],
+        'pharmacy_name': rows['pharmacy_name'].to_numpy(dtype=object)[series],
+        'service': rows['service'].to_numpy(dtype=object)[series],
+        'label': rows['label'].to_numpy(dtype=object)[series],
+        'Month_dt': months[month],
+        'value': values[series, month],
+        'kind': kind[series, month],
+        'score': score[series, month]
+    }, columns=ANOMALY_COLUMNS)
+    rank = flagged['kind'].map(KIND_ORDER)
+    order = np.lexsort((-flagged['score'].abs().to_numpy(), rank.to_numpy()))
+    return flagged.iloc[order].reset_index(drop=True)
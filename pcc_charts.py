@@ -0,0 +1,295 @@
+import numpy as np
+import pandas as pd
+import plotly.express as px
+import plotly.graph_objects as go
+
+
+def add_target_line(fig, target):
+    fig.add_hline(
+        y=target,
+        line_dash="dash",
+        line_color="red",
+        annotation_text=f"Target Performance = {target}",
+        annotation_position="top left"
+    )
+
+
+# Line charts with more points than this are drawn with WebGL (Scattergl) instead of SVG
+WEBGL_POINT_THRESHOLD = 1000
+
+# In WebGL mode each series of the overview is downsampled to at most this many points
+MAX_OVERVIEW_POINTS = 500
+
+
+def lttb_indices(x, y, n_out):
+    # Largest-Triangle-Three-Buckets: indices of n_out points that keep the visual shape of the
+    # (x, y) series. The first and last points are always kept; x must be sorted and numeric
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(n_out - 2):
+        start, end = edges[i], edges[i + 1]
+        # The third vertex is the mean of the next bucket (or the last point)
+        next_end = edges[i + 2] if i + 2 < len(edges) else n
+        mean_x, mean_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs(
+            (x[previous] - mean_x) * (y[start:end] - y[previous])
+            - (x[previous] - x[start:end]) * (mean_y - y[previous])
+        )
+        previous = start + int(np.argmax(area))
+        keep[i + 1] = previous
+    return keep
+
+
+def overview_points(data, group=None, max_points=MAX_OVERVIEW_POINTS):
+    # Rows of a long-format month table thinned with LTTB to at most max_points per series;
+    # blank months are left out of thinned series
+    def thin(series):
+        series = series[series['Value'].notna()]
+        x = series['Month_dt'].to_numpy(dtype='datetime64[ns]').astype(np.int64).astype(float)
+        return series.iloc[lttb_indices(x, series['Value'].to_numpy(dtype=float), max_points)]
+
+    if group is None:
+        return thin(data)
+    return pd.concat([thin(series) for _, series in data.groupby(group, sort=False, observed=True)])
+
+
+def _month_axis(fig, n_months):
+    # One tick per month while that stays readable, otherwise let plotly choose
+    if n_months <= 36:
+        fig.update_layout(xaxis_tickformat='%b %y', xaxis=dict(tickmode='linear', dtick="M1"))
+    else:
+        fig.update_layout(xaxis_tickformat='%b %y')
+
+
+def add_forecast_band(fig, forecast, last_point=None):
+    # Dashed projection with a shaded uncertainty band; forecast has Month_dt, forecast, lower
+    # and upper columns. last_point (month, value) joins the projection to the history
+    forecast = forecast[forecast['forecast'].notna()]
+    if forecast.empty:
+        return
+    x, mean, lower, upper = (forecast[column].tolist() for column in ('Month_dt', 'forecast', 'lower', 'upper'))
+    if last_point is not None:
+        x, mean, lower, upper = [last_point[0]] + x, [last_point[1]] + mean, [last_point[1]] + lower, [last_point[1]] + upper
+
+    fig.add_trace(go.Scatter(x=x, y=upper, mode='lines', line=dict(width=0), hoverinfo='skip', showlegend=False))
+    fig.add_trace(go.Scatter(
+        x=x, y=lower, mode='lines', line=dict(width=0), fill='tonexty', fillcolor='rgba(128, 128, 128, 0.2)',
+        hoverinfo='skip', showlegend=False
+    ))
+    fig.add_trace(go.Scatter(
+        x=x, y=mean, mode='lines', name="Forecast", line=dict(dash='dash', color='gray'),
+        hovertemplate="Forecast %{x|%b %y}: %{y:.0f}<extra></extra>", showlegend=False
+    ))
+
+
+def add_anomaly_markers(fig, anomalies):
+    # Red crosses over the points pcc_anomalies flagged, with the reason on hover
+    if anomalies is None or anomalies.empty:
+        return
+    fig.add_trace(go.Scatter(
+        x=anomalies['Month_dt'],
+        y=anomalies['value'],
+        mode='markers',
+        name="Flagged",
+        marker=dict(symbol='x', size=11, color='red', line=dict(width=1)),
+        customdata=np.stack([anomalies['label'], anomalies['kind']], axis=-1),
+        hovertemplate="%{customdata[0]} %{x|%b %y}: %{y:.0f}<br>Flagged: %{customdata[1]}<extra></extra>",
+        showlegend=False
+    ))
+
+
+def service_trend_figure(chart_data, title, target=None, full_resolution=False, forecast=None, anomalies=None):
+    # Monthly values of one service at one pharmacy; gaps are drawn as zero. forecast, if
+    # given, is drawn as a band after the last month, and flagged anomalies as markers
+    chart_data = chart_data.assign(Value=chart_data['Value'].fillna(0))
+    n_months = len(chart_data)
+    webgl = n_months > WEBGL_POINT_THRESHOLD
+    if webgl and not full_resolution:
+        chart_data = overview_points(chart_data)
+
+    fig = px.line(
+        chart_data,
+        x='Month_dt',
+        y='Value',
+        title=title,
+        markers=not webgl,
+        render_mode='webgl' if webgl else 'auto',
+        labels={'Month_dt': 'Month', 'Value': title}
+    )
+
+    if target is not None:
+        add_target_line(fig, target)
+
+    if forecast is not None and not chart_data.empty:
+        last = chart_data.iloc[-1]
+        add_forecast_band(fig, forecast, (last['Month_dt'], last['Value']))
+        n_months += len(forecast)
+    add_anomaly_markers(fig, anomalies)
+
+    _month_axis(fig, n_months)
+    return fig
+
+
+def pharmacy_trends_figure(trend_df, pharmacy_name, full_resolution=False, anomalies=None):
+    # All services of one pharmacy, one line per service, with flagged anomalies marked
+    n_months = trend_df['Month_dt'].nunique()
+    webgl = len(trend_df) > WEBGL_POINT_THRESHOLD
+    if webgl and not full_resolution:
+        trend_df = overview_points(trend_df, group='Service')
+
+    fig = px.line(
+        trend_df,
+        x="Month_dt",
+        y="Value",
+        color="Service",
+        markers=not webgl,
+        render_mode='webgl' if webgl else 'auto',
+        title=f"📈 Monthly Trends of All Services: {pharmacy_name}",
+        labels={"Month_dt": "Month", "Value": "Count", "Service": "Service Type"},
+        width=1000,
+        height=600
+    )
+
+    add_anomaly_markers(fig, anomalies)
+    _month_axis(fig, n_months)
+    fig.update_layout(
+        legend_title_text="Service",
+        title_x=0.25,
+        margin=dict(l=20, r=20, t=60, b=40),
+        clickmode="event+select",
+        legend_itemclick="toggleothers",
+        legend_itemdoubleclick="toggle"
+    )
+    return fig
+
+
+def history_figure(series, title, target=None):
+    # One service across pharmacies from the fact store, one line per pharmacy
+    webgl = len(series) > WEBGL_POINT_THRESHOLD
+    fig = px.line(
+        series,
+        x="Month_dt",
+        y="Value",
+        color="pharmacy_name",
+        markers=not webgl,
+        render_mode='webgl' if webgl else 'auto',
+        title=title,
+        labels={"Month_dt": "Month", "Value": title, "pharmacy_name": "Pharmacy"},
+        height=600
+    )
+
+    if target is not None:
+        add_target_line(fig, target)
+
+    _month_axis(fig, series['Month_dt'].nunique())
+    fig.update_layout(
+        margin=dict(l=20, r=20, t=60, b=40),
+        legend_itemclick="toggleothers",
+        legend_itemdoubleclick="toggle"
+    )
+    return fig
+
+
+def pcm_comparison_data(rows):
+    # rows is a slice of the service table. Returns the rows with a valid Average PCM, plus the
+    # display names whose negative values were dropped
+    rows = rows[rows['pcm'].notna()]
+    negative = rows.loc[rows['pcm'] < 0, 'display'].tolist()
+    return rows[rows['pcm'] >= 0], negative
+
+
+def pcm_comparison_figure(rows, services):
+    # Average PCM of every pharmacy for every service as one grouped bar chart with one trace
+    # per pharmacy. services is an ordered list of (key, label, target); each service with a
+    # target gets a target line spanning its group of bars
+    labels = {key: label for key, label, _ in services}
+    present = [key for key, _, _ in services if key in set(rows['service'])]
+    categories = [labels[key] for key in present]
+
+    fig = go.Figure()
+    for (_, name), pharmacy_rows in rows.groupby(['pharmacy', 'pharmacy_name'], sort=False):
+        values = pharmacy_rows['pcm'].round().astype(int)
+        fig.add_trace(go.Bar(
+            x=pharmacy_rows['service'].map(labels).tolist(),
+            y=values.tolist(),
+            name=name,
+            marker_color=pharmacy_rows['color'].iloc[0],
+            marker_line_color='black',
+            marker_line_width=1.2,
+            text=values.tolist(),
+            textposition="outside"
+        ))
+
+    for key, _, target in services:
+        if target is None or key not in present:
+            continue
+        x = present.index(key)
+        fig.add_shape(
+            type="line", xref="x", yref="y", x0=x - 0.45, x1=x + 0.45, y0=target, y1=target,
+            line=dict(color="red", dash="dash")
+        )
+        fig.add_annotation(
+            x=x - 0.45, y=target, xref="x", yref="y", text=f"Target = {target}",
+            showarrow=False, xanchor="left", yanchor="bottom", font=dict(color="red")
+        )
+
+    fig.update_layout(
+        barmode="group",
+        xaxis=dict(type="category", categoryorder="array", categoryarray=categories),
+        xaxis_tickangle=-45,
+        height=700,
+        margin=dict(l=20, r=20, t=40, b=20),
+        showlegend=True,
+        legend_title_text="Pharmacy",
+        clickmode="event+select",
+        legend_itemclick="toggleothers",
+        legend_itemdoubleclick="toggle"
+    )
+    return fig
+
+
+def compliance_heatmap_figure(compliance):
+    # compliance is pcc_kpis.compliance_matrix output: one row per pharmacy/service with a
+    # target, one column per month, coloured by the month's value as a percentage of target
+    n_months = len(compliance['Month'].cat.categories)
+    n_rows = len(compliance) // n_months if n_months else 0
+    first = compliance.iloc[::n_months] if n_months else compliance
+
+    def grid(column):
+        return compliance[column].to_numpy(dtype=float).reshape(n_rows, n_months)
+
+    value, target, gap = grid('value'), grid('target'), grid('gap')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        attainment = np.where(target > 0, value / target * 100, np.nan)
+
+    fig = go.Figure(go.Heatmap(
+        z=attainment,
+        x=compliance['Month_dt'].iloc[:n_months],
+        y=(first['label'] + " (" + first['pharmacy_name'] + ")").tolist(),
+        customdata=np.dstack([value, target, gap]),
+        hovertemplate="%{y}<br>%{x|%b %y}: %{customdata[0]:.0f} "
+                      "(target %{customdata[1]:.0f}, gap %{customdata[2]:+.0f})<extra></extra>",
+        colorscale="RdYlGn",
+        zmin=0,
+        zmid=100,
+        zmax=200,
+        xgap=1,
+        ygap=1,
+        colorbar=dict(title="% of target")
+    ))
+
+    fig.update_layout(
+        title="🎯 Monthly Target Compliance",
+        xaxis_tickformat="%b %y",
+        xaxis=dict(tickmode="linear", dtick="M1"),
+        yaxis=dict(autorange="reversed"),
+        height=max(300, 28 * n_rows + 150),
+        margin=dict(l=20, r=20, t=60, b=40)
+    )
+    return fig
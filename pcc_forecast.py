@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+from pcc_kpis import value_matrix
+
+
+# Months projected ahead; the at-risk ranking looks at the average over this horizon
+FORECAST_HORIZON = 3
+
+# Seasonal (Holt-Winters) models need two full seasons of history, otherwise a linear trend
+SEASON_LENGTH = 12
+
+# Smoothing weights for level, trend and season
+ALPHA, BETA, GAMMA = 0.3, 0.1, 0.2
+
+# Half-width of the forecast band in residual standard deviations (about 80% coverage)
+BAND_Z = 1.28
+
+# Series with fewer observed months than this are not forecast
+MIN_OBSERVATIONS = 4
+
+
+def _nanmean(values, axis):
+    counts = np.count_nonzero(~np.isnan(values), axis=axis)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, np.nansum(values, axis=axis) / np.maximum(counts, 1), np.nan)
+
+
+def _residual_sigma(errors, dof):
+    counts = np.count_nonzero(~np.isnan(errors), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.sqrt(np.nansum(errors ** 2, axis=1) / np.maximum(counts - dof, 1))
+
+
+def linear_trend(values, horizon):
+    # Least-squares line through every row's observed months at once. Returns the forecasts
+    # for the next `horizon` months and the residual standard deviation per row
+    n = values.shape[1]
+    t = np.arange(n, dtype=float)
+    observed = ~np.isnan(values)
+    t_mean = _nanmean(np.where(observed, t, np.nan), axis=1)
+    y_mean = _nanmean(values, axis=1)
+
+    dt = np.where(observed, t - t_mean[:, None], 0.0)
+    dy = np.where(observed, values - y_mean[:, None], 0.0)
+    denominator = (dt ** 2).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slope = np.where(denominator > 0, (dt * dy).sum(axis=1) / denominator, 0.0)
+    intercept = y_mean - slope * t_mean
+
+    fitted = intercept[:, None] + slope[:, None] * t
+    sigma = _residual_sigma(np.where(observed, values - fitted, np.nan), dof=2)
+    steps = np.arange(n, n + horizon, dtype=float)
+    return intercept[:, None] + slope[:, None] * steps, sigma
+
+
+def holt_winters(values, horizon, season=SEASON_LENGTH):
+    # Additive Holt-Winters run over all rows together; the loop is over months, not series.
+    # Blank months are filled with the one-step prediction so they do not pull the state
+    n_series, n = values.shape
+    level = _nanmean(values[:, :season], axis=1)
+    trend = (_nanmean(values[:, season:2 * season], axis=1) - level) / season
+    seasonal = np.nan_to_num(values[:, :season] - level[:, None])
+    level, trend = np.nan_to_num(level), np.nan_to_num(trend)
+
+    errors = np.full((n_series, n), np.nan)
+    for t in range(n):
+        s = seasonal[:, t % season]
+        predicted = level + trend + s
+        y = values[:, t]
+        observed = ~np.isnan(y)
+        if t >= season:
+            errors[:, t] = np.where(observed, y - predicted, np.nan)
+        y = np.where(observed, y, predicted)
+
+        new_level = ALPHA * (y - s) + (1 - ALPHA) * (level + trend)
+        trend = BETA * (new_level - level) + (1 - BETA) * trend
+        seasonal[:, t % season] = GAMMA * (y - new_level) + (1 - GAMMA) * s
+        level = new_level
+
+    steps = np.arange(1, horizon + 1)
+    forecast = level[:, None] + steps * trend[:, None] + seasonal[:, (n + steps - 1) % season]
+    return forecast, _residual_sigma(errors, dof=0)
+
+
+def forecast_matrix(values, horizon=FORECAST_HORIZON):
+    # Forecast every row of a chronological (series, month) matrix. Returns (method, forecast,
+    # lower, upper) with (series, horizon) arrays; counts cannot go below zero
+    n = values.shape[1]
+    if n >= 2 * SEASON_LENGTH:
+        method = "holt_winters"
+        forecast, sigma = holt_winters(values, horizon)
+    else:
+        method = "linear_trend"
+        forecast, sigma = linear_trend(values, horizon)
+
+    too_short = np.count_nonzero(~np.isnan(values), axis=1) < MIN_OBSERVATIONS
+    forecast[too_short] = np.nan
+    width = BAND_Z * sigma[:, None] * np.sqrt(np.arange(1, horizon + 1))
+    return method, np.maximum(forecast, 0), np.maximum(forecast - width, 0), np.maximum(forecast + width, 0)
+
+
+def dataset_forecast(dataset, positions, horizon=FORECAST_HORIZON):
+    # Forecasts for the services at the given sheet row positions, one row per (position,
+    # future month), with the method used
+    positions = list(positions)
+    method, forecast, lower, upper = forecast_matrix(value_matrix(dataset, positions), horizon)
+
+    last_month = dataset.facts['Month_dt'].iloc[len(dataset.months) - 1] if dataset.months else pd.NaT
+    future = pd.date_range(last_month, periods=horizon + 1, freq='MS')[1:]
+    return pd.DataFrame({
+        'position': np.repeat(positions, horizon),
+        'Month_dt': np.tile(future, len(positions)),
+        'forecast': forecast.ravel(),
+        'lower': lower.ravel(),
+        'upper': upper.ravel(),
+        'method': method
+    })
+
+
+def at_risk_table(service_table, forecast):
+    # Branches whose average forecast over the horizon is below their service's target, worst
+    # first. 'likely' marks those where even the top of the band stays below target
+    projected = forecast.groupby('position', sort=False)[['forecast', 'lower', 'upper']].mean()
+    rows = service_table[service_table['target'].notna()].join(projected, on='position')
+    rows = rows[rows['forecast'].notna()]
+    rows = rows.assign(gap=rows['forecast'] - rows['target'], likely=rows['upper'] < rows['target'])
+    return rows[rows['gap'] < 0].sort_values('gap')
@@ -0,0 +1,189 @@
+import datetime
+import json
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from pcc_loader import apply_schema, build_pharmacy_service_index, detect_pharmacy_blocks
+from pcc_merge import _series_frame, combined_hash, merge_pcc_tables, month_sort_key, table_period
+from snapshot_store import SNAPSHOT_DIR, load_snapshot, save_snapshot, snapshot_path
+
+
+# The stored history is one normalized table kept next to the snapshots, plus a JSON log of
+# the exports applied to it and the cells each one changed
+HISTORY_DIR = os.environ.get("PCC_HISTORY_DIR", os.path.join(os.path.dirname(SNAPSHOT_DIR), "history"))
+HISTORY_KEY = "history"
+LOG_NAME = "history.json"
+
+CHANGE_COLUMNS = ['pharmacy', 'service', 'month', 'old', 'new', 'kind']
+
+_lock = threading.Lock()
+
+
+def _log_path(history_dir):
+    return os.path.join(history_dir, LOG_NAME)
+
+
+def load_history_log(history_dir=None):
+    try:
+        with open(_log_path(history_dir or HISTORY_DIR)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {'applied': [], 'refreshes': []}
+
+
+def _save_history_log(log, history_dir):
+    path = _log_path(history_dir)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(log, f)
+    os.replace(tmp_path, path)
+
+
+def history_hash(log):
+    # Changes exactly when another export has been applied, so it can key derived caches
+    return combined_hash(log['applied']) if log['applied'] else None
+
+
+def load_history(history_dir=None):
+    # The stored table as (df, service_column, months), or None if nothing has been stored
+    return load_snapshot(HISTORY_KEY, history_dir or HISTORY_DIR)
+
+
+def clear_history(history_dir=None):
+    history_dir = history_dir or HISTORY_DIR
+    with _lock:
+        try:
+            names = os.listdir(history_dir)
+        except OSError:
+            return
+        for name in names:
+            if name.startswith(HISTORY_KEY + "."):
+                try:
+                    os.remove(os.path.join(history_dir, name))
+                except OSError:
+                    pass
+
+
+def apply_export(stored, incoming):
+    # Apply one normalized export to the stored table. Only the incoming months are compared;
+    # cells are written in place when every incoming series already exists, otherwise the
+    # tables are merged. An export older than the stored history only fills blank cells, as
+    # in merge_pcc_tables. Returns the updated table and a DataFrame of the changed cells.
+    df, service_column, months = stored
+    frame, _ = _series_frame(*incoming)
+    incoming_months = incoming[2]
+
+    _, row_pharmacy = detect_pharmacy_blocks(df, service_column, months)
+    index = build_pharmacy_service_index(df, service_column, row_pharmacy)
+    positions = np.array([index.get(key, -1) for key in frame.index], dtype=int)
+    known = positions >= 0
+    overwrite = table_period(incoming) >= table_period(stored)
+
+    stored_months = set(months)
+    new_months = [month for month in incoming_months if month not in stored_months]
+    old_values = np.full((len(frame), len(incoming_months)), np.nan)
+    shared = [i for i, month in enumerate(incoming_months) if month in stored_months]
+    if shared:
+        old_values[np.ix_(known.nonzero()[0], shared)] = (
+            df[[incoming_months[i] for i in shared]].to_numpy(dtype=float)[positions[known]]
+        )
+    new_values = frame[incoming_months].to_numpy(dtype=float)
+
+    present = ~np.isnan(new_values)
+    if overwrite:
+        changed = present & ~(old_values == new_values)
+    else:
+        changed = present & np.isnan(old_values)
+
+    rows, cols = changed.nonzero()
+    changes = pd.DataFrame({
+        'pharmacy': frame.index.get_level_values('pharmacy')[rows],
+        'service': frame['label'].to_numpy(dtype=object)[rows],
+        'month': np.asarray(incoming_months, dtype=object)[cols],
+        'old': old_values[rows, cols],
+        'new': new_values[rows, cols],
+        'kind': np.where(~known[rows], 'new series', np.where(np.isnan(old_values[rows, cols]), 'added', 'revised'))
+    }, columns=CHANGE_COLUMNS)
+
+    if not known.all():
+        return merge_pcc_tables([stored, incoming]), changes
+
+    df = df.copy()
+    for month in new_months:
+        df[month] = np.nan
+    for col in np.unique(cols):
+        month = incoming_months[col]
+        hit = changed[:, col]
+        values = df[month].to_numpy(dtype=float).copy()
+        values[positions[hit]] = new_values[hit, col]
+        df[month] = values
+    if 'Average PCM' in df.columns:
+        # An export's "Average PCM" covers only its own months, as in merge_pcc_tables
+        df['Average PCM'] = np.nan
+
+    # Keep the label columns, then every month chronologically, then the rest
+    months = sorted(set(months) | set(new_months), key=month_sort_key)
+    first_month = min(list(df.columns).index(month) for month in months)
+    leading = list(df.columns[:first_month])
+    trailing = [col for col in df.columns[first_month:] if col not in stored_months | set(new_months)]
+    return (apply_schema(df[leading + months + trailing], months), service_column, months), changes
+
+
+def append_exports(files, load_table, history_dir=None):
+    # files is a list of (file_bytes, file_hash); exports already applied are skipped and the
+    # rest are applied oldest period first. load_table parses one workbook, e.g. the cached
+    # load_pcc_table. Returns the updated log and the refreshes made by this call.
+    history_dir = history_dir or HISTORY_DIR
+    with _lock:
+        log = load_history_log(history_dir)
+        if not os.path.exists(snapshot_path(HISTORY_KEY, history_dir)):
+            # A missing or outdated table invalidates the log that described it
+            log = {'applied': [], 'refreshes': []}
+        applied = set(log['applied'])
+        pending = [(file_bytes, file_hash) for file_bytes, file_hash in files if file_hash not in applied]
+        if not pending:
+            return log, []
+
+        stored = load_history(history_dir) if log['applied'] else None
+        tables = sorted(
+            ((load_table(file_bytes, file_hash), file_hash) for file_bytes, file_hash in pending),
+            key=lambda item: table_period(item[0])
+        )
+        refreshes = []
+        for table, file_hash in tables:
+            if stored is None:
+                stored = table
+                changes = pd.DataFrame(columns=CHANGE_COLUMNS)
+                new_months = list(table[2])
+            else:
+                stored_months = set(stored[2])
+                new_months = [month for month in table[2] if month not in stored_months]
+                stored, changes = apply_export(stored, table)
+
+            refreshes.append({
+                'file_hash': file_hash,
+                'applied_at': datetime.datetime.now().isoformat(timespec='seconds'),
+                'new_months': new_months,
+                'added': int((changes['kind'] == 'added').sum()),
+                'revised': int((changes['kind'] == 'revised').sum()),
+                'new_series': int(changes.loc[changes['kind'] == 'new series', ['pharmacy', 'service']].drop_duplicates().shape[0]),
+                'changes': changes.astype({'old': float, 'new': float}).replace({np.nan: None}).values.tolist()
+            })
+            log['applied'].append(file_hash)
+
+        os.makedirs(history_dir, exist_ok=True)
+        # The history is the only copy of the data, so it is never pruned like the snapshot
+        # cache, and the log only records exports once the table holding them is written
+        if not save_snapshot(HISTORY_KEY, *stored, snapshot_dir=history_dir, prune=False):
+            raise OSError(f"Could not write the stored history to {history_dir}")
+        log['refreshes'].extend(refreshes)
+        _save_history_log(log, history_dir)
+        return log, refreshes
+
+
+def refresh_changes(refresh):
+    # The cell-level change log of one refresh as a DataFrame
+    return pd.DataFrame(refresh['changes'], columns=CHANGE_COLUMNS)
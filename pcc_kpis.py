@@ -0,0 +1,99 @@
+import numpy as np
+import pandas as pd
+
+
+# Trailing windows, in months, averaged alongside the whole-period mean
+KPI_WINDOWS = (3, 6, 12)
+
+# Column headings for KPI tables, in display order; average_pcm is the export's own value
+KPI_LABELS = {
+    'months_reported': "Months reported",
+    'total': "Total",
+    'mean_pcm': "Average PCM",
+    'average_pcm': "Average PCM (export)",
+    **{f'avg_{months}m': f"Last {months} months" for months in KPI_WINDOWS},
+    'growth_pct': "Quarter growth %"
+}
+
+# The export rounds "Average PCM"; differences within this are not reported as mismatches
+PCM_TOLERANCE = 0.5
+
+
+def _window_mean(values, months):
+    # Mean of the last `months` columns of every row, ignoring blank months; NaN if all blank
+    window = values[:, -months:]
+    counts = np.count_nonzero(~np.isnan(window), axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, np.nansum(window, axis=1) / counts, np.nan)
+
+
+def compute_kpis(values, reported_pcm=None):
+    # values is a (series, months) matrix in chronological order. Every KPI is computed for all
+    # series at once; reported_pcm, the export's "Average PCM" per series, is cross-checked
+    n_months = values.shape[1]
+    reported = np.count_nonzero(~np.isnan(values), axis=1)
+    mean_pcm = _window_mean(values, n_months)
+
+    kpis = {
+        'months_reported': reported,
+        'total': np.nansum(values, axis=1),
+        'mean_pcm': mean_pcm
+    }
+    for months in KPI_WINDOWS:
+        kpis[f'avg_{months}m'] = _window_mean(values, months)
+
+    # Growth of the latest quarter over the one before it
+    if n_months >= 6:
+        previous = _window_mean(values[:, :-3], 3)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            growth = np.where(previous > 0, (kpis['avg_3m'] - previous) / previous * 100, np.nan)
+    else:
+        growth = np.full(len(values), np.nan)
+    kpis['growth_pct'] = growth
+
+    if reported_pcm is not None:
+        reported_pcm = np.asarray(reported_pcm, dtype=float)
+        both = ~np.isnan(mean_pcm) & ~np.isnan(reported_pcm)
+        kpis['pcm_mismatch'] = both & ~np.isclose(mean_pcm, reported_pcm, rtol=0, atol=PCM_TOLERANCE)
+
+    return pd.DataFrame(kpis)
+
+
+def value_matrix(dataset, positions):
+    # Monthly values of the services at the given sheet row positions as a (series, month)
+    # matrix, taken straight from the fact table, whose blocks are already chronological
+    positions = list(positions)
+    matrix = dataset.facts['Value'].to_numpy().reshape(len(dataset.fact_blocks), len(dataset.months))
+    blocks = np.fromiter((dataset.fact_blocks[position] for position in positions), dtype=int, count=len(positions))
+    # Values are stored as float32; the selected rows are widened for the arithmetic
+    return matrix[blocks].astype(float)
+
+
+def dataset_kpis(dataset, positions, reported_pcm=None):
+    # KPIs for the services at the given sheet row positions
+    return compute_kpis(value_matrix(dataset, positions), reported_pcm)
+
+
+def compliance_matrix(dataset, rows):
+    # rows is a slice of the service table with a 'target' column. Returns one row per
+    # (pharmacy, service, month) of the services that have a target, rows-major in the order
+    # given, with the month's value, the target, the gap to it and whether it was met
+    rows = rows[rows['target'].notna()]
+    n_months = len(dataset.months)
+    values = value_matrix(dataset, rows['position'])
+    targets = rows['target'].to_numpy(dtype=float)[:, None]
+    gap = values - targets
+
+    months = dataset.facts['Month'].iloc[:n_months]
+    return pd.DataFrame({
+        'pharmacy': np.repeat(rows['pharmacy'].to_numpy(dtype=object), n_months),
+        'pharmacy_name': np.repeat(rows['pharmacy_name'].to_numpy(dtype=object), n_months),
+        'service': np.repeat(rows['service'].to_numpy(dtype=object), n_months),
+        'label': np.repeat(rows['label'].to_numpy(dtype=object), n_months),
+        'Month': pd.Categorical(np.tile(months.to_numpy(dtype=object), len(rows)), dtype=months.dtype),
+        'Month_dt': np.tile(dataset.facts['Month_dt'].iloc[:n_months].to_numpy(), len(rows)),
+        'value': values.ravel(),
+        'target': np.broadcast_to(targets, values.shape).ravel(),
+        'gap': gap.ravel(),
+        'met': pd.array(np.where(np.isnan(values), None, gap >= 0).ravel(), dtype='boolean')
+    })
@@ -0,0 +1,337 @@
+import datetime
+import hashlib
+import io
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+
+import numpy as np
+import pandas as pd
+from openpyxl import load_workbook
+
+from snapshot_store import load_snapshot, save_snapshot
+
+
+MONTH_PATTERN = re.compile(r'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-\d{2}$')
+# A month label filling a whole cell of a row whose text cells are joined by CELL_SEPARATOR
+CELL_SEPARATOR = '\x1f'
+MONTH_CELL_PATTERN = re.compile(r'(?:^|\x1f)\s*(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-\d{2}\s*(?:\x1f|$)')
+# Date cells needed for a row without month text to count as the header row
+MIN_DATE_HEADERS = 2
+
+# Pharmacy block titles end with the branch's ODS code, e.g. "REVELSTOKE PHARMACY FE297"
+PHARMACY_PATTERN = re.compile(r'^(?P<name>.*\S)\s+\(?(?P<code>F[A-Z0-9]{4})\)?$')
+DEDUP_SUFFIX = re.compile(r'_\d+$')
+
+# Month counts and "Average PCM" are held as float32 with NaN for blanks (exact for whole
+# counts up to 16 million); every other column is categorical text with '' for blanks
+VALUE_DTYPE = np.float32
+
+
+def content_hash(file_bytes):
+    # Stable key for an uploaded workbook, independent of its file name
+    return hashlib.sha256(file_bytes).hexdigest()
+
+
+def _header_label(value):
+    # Month headers may be typed as "Jan-24" text or stored as real dates by Excel
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.strftime('%b-%y')
+    if isinstance(value, str):
+        return value.strip()
+    # Blank headers become NaN column labels, as pandas gives them
+    return float('nan') if value is None else value
+
+
+def _is_header_row(row):
+    # One regex search over the row's text cells joined by a separator no label contains.
+    # Excel may store the month headers as dates instead, but a lone date such as a "Report
+    # generated" stamp is no header: it takes several, or one beside the "Average PCM" label
+    texts = [value for value in row if isinstance(value, str)]
+    if MONTH_CELL_PATTERN.search(CELL_SEPARATOR.join(texts)):
+        return True
+    dates = sum(isinstance(value, (datetime.date, datetime.datetime)) for value in row)
+    return dates >= MIN_DATE_HEADERS or (dates > 0 and "Average PCM" in map(str.strip, texts))
+
+
+def find_header_row(rows):
+    # Consume rows until the first one carrying month labels; the iterator is left just past it
+    for row in rows:
+        if _is_header_row(row):
+            return [_header_label(value) for value in row]
+    return None
+
+
+def dedup_labels(labels):
+    # Every pharmacy block repeats the same service labels; later repeats get _1, _2, ... suffixes.
+    # Repeats are found on the normalized key, so blocks spelling a label with other case or
+    # spacing are still told apart by the lookups, which all ignore case and spacing
+    labels = labels.astype(str).str.strip()
+    keys = labels.str.upper()
+    return labels.where(
+        ~keys.duplicated(),
+        labels + '_' + keys.groupby(keys).cumcount().astype(str)
+    )
+
+
+def apply_schema(df, months):
+    # Cast a normalized table to its typed layout in place; columns already typed are left
+    # alone, so merged and updated tables can be passed through again cheaply
+    numeric = set(months) | {'Average PCM'}
+    for col in df.columns:
+        column = df[col]
+        if isinstance(col, str) and col in numeric:
+            if column.dtype != VALUE_DTYPE:
+                df[col] = pd.to_numeric(column, errors='coerce').astype(VALUE_DTYPE)
+        elif not isinstance(column.dtype, pd.CategoricalDtype):
+            # Text columns mix labels, blanks and stray numbers; one categorical per column
+            # stores each distinct label once
+            df[col] = column.fillna('').astype(str).astype('category')
+    return df
+
+
+def normalize_pcc_table(df):
+    df.dropna(axis=1, how='all', inplace=True)
+
+    service_column = df.columns[0]
+
+    df[service_column] = dedup_labels(df[service_column].fillna(''))
+
+    months = [col for col in df.columns if isinstance(col, str) and MONTH_PATTERN.match(col)]
+    return apply_schema(df, months), service_column, months
+
+
+def column_memory(df):
+    # Deep size in bytes and dtype of every column, by position since labels may repeat
+    return pd.DataFrame({
+        'column': [str(col) for col in df.columns],
+        'dtype': [str(dtype) for dtype in df.dtypes],
+        'bytes': df.memory_usage(index=False, deep=True).to_numpy()
+    })
+
+
+def memory_report(raw, typed):
+    # Bytes per column of a sheet as read (object cells) next to its typed table, with a
+    # total row; the columns normalize_pcc_table drops as empty are left out of both
+    before = column_memory(raw.dropna(axis=1, how='all'))
+    after = column_memory(typed)
+    report = pd.DataFrame({
+        'column': after['column'],
+        'dtype_before': before['dtype'],
+        'bytes_before': before['bytes'],
+        'dtype': after['dtype'],
+        'bytes': after['bytes']
+    })
+    total = {'column': "Total", 'dtype_before': "", 'bytes_before': report['bytes_before'].sum(),
+             'dtype': "", 'bytes': report['bytes'].sum()}
+    return pd.concat([report, pd.DataFrame([total])], ignore_index=True)
+
+
+def normalize_service_key(label):
+    return str(label).strip().upper()
+
+
+def strip_dedup_suffix(label):
+    return DEDUP_SUFFIX.sub('', str(label).strip())
+
+
+@dataclass(frozen=True)
+class Pharmacy:
+    code: str
+    name: str
+
+
+def detect_pharmacy_blocks(df, service_column, months):
+    # A row opens a new pharmacy block when its label ends in an ODS code and it carries no
+    # monthly figures. The first block is titled by the header row, i.e. the service column name.
+    labels = df[service_column].str.strip().str.replace(DEDUP_SUFFIX, '', regex=True)
+    is_title = labels.str.match(PHARMACY_PATTERN) & df[months].isna().all(axis=1)
+
+    titles = [str(service_column).strip()] + labels[is_title].tolist()
+    pharmacies = []
+    for title in titles:
+        match = PHARMACY_PATTERN.match(title)
+        pharmacies.append(Pharmacy(code=match.group('code'), name=title) if match else Pharmacy(code=title, name=title))
+
+    # Tag every row with its block in one pass; repeated titles fold into the same pharmacy
+    codes, unique_codes = pd.factorize(pd.Series([pharmacy.code for pharmacy in pharmacies]))
+    block_of_row = is_title.to_numpy().cumsum()
+    row_pharmacy = pd.Categorical.from_codes(codes[block_of_row], categories=unique_codes)
+
+    first_seen = {}
+    for pharmacy in pharmacies:
+        first_seen.setdefault(pharmacy.code, pharmacy)
+    return list(first_seen.values()), row_pharmacy
+
+
+def build_service_index(df, service_column):
+    # Normalized service label -> row position of its first occurrence. The de-dup suffixes
+    # (NMS_1, NMS_2, ...) are part of the label, so each pharmacy block keeps its own entry
+    keys = df[service_column].str.strip().str.upper()
+    first = ~keys.duplicated()
+    return dict(zip(keys[first], first.to_numpy().nonzero()[0].tolist()))
+
+
+def build_pharmacy_service_index(df, service_column, row_pharmacy):
+    # (pharmacy code, service label without de-dup suffix) -> row position, so a pharmacy's
+    # services can be found without knowing which _N suffix its block was given
+    keys = df[service_column].str.strip().str.upper().str.replace(DEDUP_SUFFIX, '', regex=True)
+    pairs = pd.DataFrame({'pharmacy': np.asarray(row_pharmacy, dtype=object), 'key': keys.to_numpy(dtype=object)})
+    first = ~pairs.duplicated()
+    return dict(zip(zip(pairs['pharmacy'][first], pairs['key'][first]), first.to_numpy().nonzero()[0].tolist()))
+
+
+def build_fact_table(df, service_column, months, row_pharmacy):
+    # Melt the wide sheet once into one row per (service, month), ordered service-major and
+    # chronologically so every service owns a contiguous block of len(months) rows
+    keys = df[service_column].str.strip().str.upper()
+    first = ~keys.duplicated()
+    labels = df.loc[first, service_column].str.strip().str.replace(DEDUP_SUFFIX, '', regex=True).str.title()
+
+    month_dt = pd.to_datetime(pd.Series(months, dtype=object), format='%b-%y')
+    order = np.argsort(month_dt.to_numpy(), kind='stable')
+    ordered_months = np.asarray(months, dtype=object)[order]
+
+    values = df.loc[first, months].to_numpy(dtype=VALUE_DTYPE)[:, order]
+    n_services, n_months = values.shape
+
+    pharmacy = np.asarray(row_pharmacy.codes)[first.to_numpy()]
+
+    return pd.DataFrame({
+        'pharmacy': pd.Categorical.from_codes(np.repeat(pharmacy, n_months), categories=row_pharmacy.categories),
+        'service_key': pd.Categorical(np.repeat(keys[first].to_numpy(dtype=object), n_months)),
+        'Service': pd.Categorical(np.repeat(labels.to_numpy(dtype=object), n_months)),
+        'Month': pd.Categorical(np.tile(ordered_months, n_services), categories=ordered_months, ordered=True),
+        'Month_dt': np.tile(month_dt.to_numpy()[order], n_services),
+        'Value': values.ravel()
+    })
+
+
+@dataclass
+class PCCDataset:
+    df: pd.DataFrame
+    service_column: object
+    months: list
+    pharmacies: list
+    service_index: dict
+    pharmacy_service_index: dict
+    facts: pd.DataFrame
+    fact_blocks: dict
+    # Content hash of the workbook the dataset came from, used to key derived caches
+    file_hash: str = None
+
+    def facts_at(self, positions):
+        n_months = len(self.months)
+        blocks = [self.fact_blocks[position] for position in positions if position is not None]
+        rows = [np.arange(block * n_months, (block + 1) * n_months) for block in blocks]
+        return self.facts.iloc[np.concatenate(rows) if rows else []]
+
+    def service_table(self, aliases):
+        # Resolve every (pharmacy, sheet label) of the dataset to its canonical service with one
+        # join against the compiled alias table (indexed by normalized label, with columns
+        # service, rank and order). One row per pharmacy reporting a service, taking the most
+        # preferred label where a pharmacy reports several; rows follow the registry order and
+        # then the pharmacy blocks, with the sheet label and parsed "Average PCM"
+        pairs = pd.DataFrame(list(self.pharmacy_service_index), columns=['pharmacy', 'alias'])
+        pairs['position'] = list(self.pharmacy_service_index.values())
+        table = pairs.join(aliases, on='alias', how='inner')
+
+        pharmacy_order = {pharmacy.code: i for i, pharmacy in enumerate(self.pharmacies)}
+        table = table.assign(block=table['pharmacy'].map(pharmacy_order))
+        table = table.sort_values(['order', 'block', 'rank'], kind='stable').drop_duplicates(['service', 'pharmacy'])
+
+        names = {pharmacy.code: pharmacy.name for pharmacy in self.pharmacies}
+        table = pd.DataFrame({
+            'service': table['service'].to_numpy(dtype=object),
+            'pharmacy': table['pharmacy'].to_numpy(dtype=object),
+            'pharmacy_name': table['pharmacy'].map(names).to_numpy(dtype=object),
+            'position': table['position'].to_numpy(dtype=int)
+        })
+        positions = table['position'].to_numpy()
+        table['label'] = self.df[self.service_column].iloc[positions].map(strip_dedup_suffix).to_numpy()
+        if 'Average PCM' in self.df.columns:
+            table['average_pcm'] = self.df['Average PCM'].to_numpy(dtype=float)[positions]
+        else:
+            table['average_pcm'] = np.nan
+        return table
+
+
+def build_dataset(df, service_column, months, file_hash=None):
+    pharmacies, row_pharmacy = detect_pharmacy_blocks(df, service_column, months)
+    service_index = build_service_index(df, service_column)
+    return PCCDataset(
+        df=df,
+        service_column=service_column,
+        months=months,
+        pharmacies=pharmacies,
+        service_index=service_index,
+        pharmacy_service_index=build_pharmacy_service_index(df, service_column, row_pharmacy),
+        facts=build_fact_table(df, service_column, months, row_pharmacy),
+        # The fact table holds one block per distinct service label, in first-occurrence order
+        fact_blocks={position: block for block, position in enumerate(service_index.values())},
+        file_hash=file_hash
+    )
+
+
+def read_pcc_sheet(file_bytes):
+    # Stream the "Table 1" sheet of a PCC export, keeping only the service label columns,
+    # the month columns and "Average PCM", as read (untyped object cells)
+    workbook = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    try:
+        sheet = workbook["Table 1"]
+        sheet.reset_dimensions()
+        rows = sheet.iter_rows(values_only=True)
+
+        header = find_header_row(rows)
+        if header is None:
+            raise ValueError("No month header row (e.g. Jan-24) found in sheet 'Table 1'.")
+
+        is_month = [isinstance(label, str) and bool(MONTH_PATTERN.match(label)) for label in header]
+        first_month = is_month.index(True)
+        keep = [
+            i for i, label in enumerate(header)
+            if i < first_month or is_month[i] or label == "Average PCM"
+        ]
+
+        width = len(header)
+        records = []
+        for row in rows:
+            if len(row) < width:
+                row = row + (None,) * (width - len(row))
+            records.append(tuple(row[i] for i in keep))
+    finally:
+        workbook.close()
+
+    return pd.DataFrame.from_records(records, columns=[header[i] for i in keep])
+
+
+def parse_pcc_workbook(file_bytes):
+    # The normalized, typed frame used by the dashboard
+    return normalize_pcc_table(read_pcc_sheet(file_bytes))
+
+
+def load_pcc_table(file_bytes, file_hash=None):
+    # Reuse the on-disk snapshot of a workbook we have already parsed, if there is one
+    if file_hash is not None:
+        snapshot = load_snapshot(file_hash)
+        if snapshot is not None:
+            return snapshot
+
+    df, service_column, months = parse_pcc_workbook(file_bytes)
+    if file_hash is not None:
+        save_snapshot(file_hash, df, service_column, months)
+    return df, service_column, months
+
+
+def load_pcc_tables(files, max_workers=None):
+    # files is a list of (file_bytes, file_hash). openpyxl parsing is CPU-bound and holds the
+    # GIL, so several workbooks are parsed in separate processes. Workers are spawned rather
+    # than forked because the Streamlit server process is multi-threaded.
+    if len(files) <= 1:
+        return [load_pcc_table(file_bytes, file_hash) for file_bytes, file_hash in files]
+
+    workers = min(len(files), max_workers or os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return list(pool.map(load_pcc_table, *zip(*files)))
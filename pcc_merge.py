@@ -0,0 +1,91 @@
+import datetime
+
+import numpy as np
+import pandas as pd
+
+from pcc_loader import VALUE_DTYPE, apply_schema, content_hash, dedup_labels, detect_pharmacy_blocks, strip_dedup_suffix
+
+
+def month_sort_key(month):
+    return datetime.datetime.strptime(month, '%b-%y')
+
+
+def table_period(table):
+    # An export is dated by the latest month it reports
+    _, _, months = table
+    return max(map(month_sort_key, months)) if months else datetime.datetime.min
+
+
+def combined_hash(file_hashes):
+    if len(file_hashes) == 1:
+        return file_hashes[0]
+    return content_hash("\n".join(file_hashes).encode())
+
+
+def _series_frame(df, service_column, months):
+    # One row per (pharmacy code, service) of a normalized table, without block title rows
+    pharmacies, row_pharmacy = detect_pharmacy_blocks(df, service_column, months)
+    names = {pharmacy.code: pharmacy.name for pharmacy in pharmacies}
+    codes = np.asarray(row_pharmacy, dtype=object)
+    labels = df[service_column].map(strip_dedup_suffix)
+
+    frame = pd.DataFrame({'pharmacy': codes, 'key': labels.str.upper().to_numpy(), 'label': labels.to_numpy()})
+    frame[months] = df[months].to_numpy(dtype=VALUE_DTYPE)
+    if 'Average PCM' in df.columns:
+        frame['Average PCM'] = df['Average PCM'].to_numpy(dtype=VALUE_DTYPE)
+
+    is_title = labels.to_numpy() == np.array([names[code] for code in codes], dtype=object)
+    frame = frame[~is_title & (frame['label'] != '')]
+    frame = frame.drop_duplicates(['pharmacy', 'key']).set_index(['pharmacy', 'key'])
+    return frame, names
+
+
+def merge_pcc_tables(tables):
+    # Merge several normalized exports into one table laid out like a single PCC sheet.
+    # Exports are applied oldest period first, so where months overlap the later export wins;
+    # cells a later export leaves blank keep the earlier value.
+    ordered = sorted(tables, key=table_period)
+
+    merged = None
+    names = {}
+    row_order = []
+    for df, service_column, months in ordered:
+        frame, frame_names = _series_frame(df, service_column, months)
+        names.update(frame_names)
+        row_order.append(frame.index)
+        merged = frame if merged is None else frame.combine_first(merged)
+
+    months = sorted({month for _, _, table_months in ordered for month in table_months}, key=month_sort_key)
+    columns = ['label'] + months + (['Average PCM'] if 'Average PCM' in merged.columns else [])
+
+    # Keep pharmacies and services in the order they were first reported
+    order = row_order[0].append(row_order[1:]).unique() if len(row_order) > 1 else row_order[0]
+    merged = merged.reindex(order)[columns].reset_index()
+    pharmacy_codes = list(dict.fromkeys(merged['pharmacy']))
+    pharmacy_rank = {code: rank for rank, code in enumerate(pharmacy_codes)}
+
+    # Re-insert a title row above every block after the first, which is titled by the header
+    titles = pd.DataFrame({
+        'pharmacy': pharmacy_codes[1:],
+        'key': '',
+        'label': [names[code] for code in pharmacy_codes[1:]]
+    })
+    merged['is_service'] = 1
+    titles['is_service'] = 0
+    rows = pd.concat([titles, merged], ignore_index=True)
+    rows['rank'] = rows['pharmacy'].map(pharmacy_rank)
+    rows = rows.sort_values(['rank', 'is_service'], kind='stable').reset_index(drop=True)
+
+    service_column = names[pharmacy_codes[0]]
+    result = pd.DataFrame({service_column: dedup_labels(rows['label'])})
+    for month in months:
+        result[month] = rows[month].to_numpy(dtype=VALUE_DTYPE)
+    if 'Average PCM' in rows.columns:
+        # Each export's "Average PCM" covers only its own months, so it says nothing about the
+        # merged history and is left blank rather than cross-checked against it
+        if len(ordered) == 1:
+            result['Average PCM'] = rows['Average PCM'].to_numpy(dtype=VALUE_DTYPE)
+        else:
+            result['Average PCM'] = np.full(len(rows), np.nan, dtype=VALUE_DTYPE)
+
+    return apply_schema(result, months), service_column, months
@@ -0,0 +1,193 @@
+"""Render the dashboard's charts for a directory of PCC exports without Streamlit.
+
+    python pcc_report.py exports/ --output reports/
+    python pcc_report.py exports/ --output reports/ --merge --png
+
+Each export gets a folder with one HTML page per pharmacy (its service trends and
+all-services chart) and an Average PCM comparison page. With --merge the exports are
+combined into a single history first, as when several files are uploaded to the dashboard.
+"""
+import argparse
+import html
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+from pcc_anomalies import dataset_anomalies
+from pcc_charts import (
+    compliance_heatmap_figure, pcm_comparison_data, pcm_comparison_figure, pharmacy_trends_figure, service_trend_figure
+)
+from pcc_forecast import FORECAST_HORIZON, at_risk_table, dataset_forecast
+from pcc_kpis import compliance_matrix
+from pcc_loader import build_dataset, content_hash, load_pcc_table, load_pcc_tables
+from pcc_merge import combined_hash, merge_pcc_tables
+from service_registry import SERVICES, build_service_table
+
+
+def _slug(text):
+    return re.sub(r'[^A-Za-z0-9]+', '_', str(text)).strip('_') or 'report'
+
+
+def _write_page(path, title, blocks, inline_js):
+    # blocks mixes HTML strings and figures; plotly.js is loaded once, with the first figure
+    parts = []
+    plotlyjs = True if inline_js else 'cdn'
+    for block in blocks:
+        if isinstance(block, str):
+            parts.append(block)
+        else:
+            parts.append(block.to_html(full_html=False, include_plotlyjs=plotlyjs))
+            plotlyjs = False
+
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(
+            "<!DOCTYPE html>\n<html><head><meta charset='utf-8'>"
+            f"<title>{html.escape(title)}</title></head>\n"
+            f"<body><h1>{html.escape(title)}</h1>\n" + "\n".join(parts) + "\n</body></html>\n"
+        )
+
+
+def _png_dir(output_dir, name, png):
+    if not png:
+        return None
+    path = os.path.join(output_dir, name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def _add_figure(blocks, fig, png_dir, name):
+    blocks.append(fig)
+    if png_dir is not None:
+        fig.write_image(os.path.join(png_dir, f"{_slug(name)}.png"))
+
+
+def render_reports(dataset, output_dir, png=False, inline_js=False):
+    # Write every chart the dashboard can show for this dataset; returns the pages written
+    os.makedirs(output_dir, exist_ok=True)
+    service_table = build_service_table(dataset)
+    forecast = dataset_forecast(dataset, service_table['position'])
+    anomalies = dataset_anomalies(dataset, service_table)
+    written = []
+
+    for pharmacy in dataset.pharmacies:
+        rows = service_table[service_table['pharmacy'] == pharmacy.code]
+        if rows.empty:
+            continue
+
+        blocks = []
+        png_dir = _png_dir(output_dir, _slug(pharmacy.code), png)
+        fig = pharmacy_trends_figure(
+            dataset.facts_at(rows['position']), pharmacy.name,
+            anomalies=anomalies[anomalies['position'].isin(rows['position'])]
+        )
+        _add_figure(blocks, fig, png_dir, "all_services")
+
+        for spec in SERVICES:
+            spec_rows = rows[rows['service'] == spec.key]
+            if spec.show_trend and not spec_rows.empty:
+                fig = service_trend_figure(
+                    dataset.facts_at(spec_rows['position']), spec.label, spec.target,
+                    forecast=forecast[forecast['position'].isin(spec_rows['position'])],
+                    anomalies=anomalies[anomalies['position'].isin(spec_rows['position'])]
+                )
+                _add_figure(blocks, fig, png_dir, spec.key)
+
+        path = os.path.join(output_dir, f"{_slug(pharmacy.code)}.html")
+        _write_page(path, f"Monthly Service Trends – {pharmacy.name}", blocks, inline_js)
+        written.append(path)
+
+    blocks = []
+    png_dir = _png_dir(output_dir, "average_pcm_comparison", png)
+    targeted = service_table[service_table['target'].notna()]
+    if not targeted.empty:
+        _add_figure(blocks, compliance_heatmap_figure(compliance_matrix(dataset, targeted)), png_dir, "compliance")
+    at_risk = at_risk_table(service_table, forecast)
+    if not at_risk.empty:
+        blocks.append(f"<h2>🚨 At Risk of Missing Target – Next {FORECAST_HORIZON} Months</h2>")
+        blocks.append(at_risk[['display', 'target', 'forecast', 'lower', 'upper', 'gap']].round(1).to_html(index=False))
+    valid_rows, negative = pcm_comparison_data(service_table)
+    blocks.extend(f"<p>⚠️ Negative PCM value for {html.escape(name)} ignored.</p>" for name in negative)
+    blocks.extend(
+        f"<p>⚠️ {html.escape(row.display)}: the export's Average PCM is {row.average_pcm:g} "
+        f"but its monthly values average {row.mean_pcm:.1f}.</p>"
+        for row in service_table[service_table['pcm_mismatch']].itertuples()
+    )
+    blocks.extend(
+        f"<p>⚠️ No valid Average PCM values found for {html.escape(spec.label)}.</p>"
+        for spec in SERVICES if not (valid_rows['service'] == spec.key).any()
+    )
+    if not valid_rows.empty:
+        fig = pcm_comparison_figure(valid_rows, [(spec.key, spec.label, spec.target) for spec in SERVICES])
+        _add_figure(blocks, fig, png_dir, "average_pcm")
+
+    path = os.path.join(output_dir, "average_pcm_comparison.html")
+    _write_page(path, "Average PCM Comparison", blocks, inline_js)
+    written.append(path)
+    return written
+
+
+def _report_one_file(path, output_dir, png, inline_js):
+    # Worker entry point: parse one export and write its reports into its own folder
+    with open(path, 'rb') as f:
+        file_bytes = f.read()
+    file_hash = content_hash(file_bytes)
+    dataset = build_dataset(*load_pcc_table(file_bytes, file_hash), file_hash=file_hash)
+    name = os.path.splitext(os.path.basename(path))[0]
+    return render_reports(dataset, os.path.join(output_dir, _slug(name)), png, inline_js)
+
+
+def find_exports(input_dir):
+    return sorted(
+        os.path.join(input_dir, name) for name in os.listdir(input_dir)
+        if name.lower().endswith('.xlsx') and not name.startswith('~$')
+    )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write static HTML/PNG dashboard reports for PCC exports.")
+    parser.add_argument("input_dir", help="directory containing PCC .xlsx exports")
+    parser.add_argument("-o", "--output", default="reports", help="directory to write reports to (default: reports)")
+    parser.add_argument("--merge", action="store_true", help="merge all exports into one history before reporting")
+    parser.add_argument("--png", action="store_true", help="also write a PNG per chart (needs the kaleido package)")
+    parser.add_argument("--inline-js", action="store_true", help="embed plotly.js so pages open without internet access")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="worker processes (default: CPU count)")
+    args = parser.parse_args(argv)
+
+    paths = find_exports(args.input_dir)
+    if not paths:
+        print(f"No .xlsx exports found in {args.input_dir}", file=sys.stderr)
+        return 1
+
+    failed = 0
+    if args.merge:
+        files = []
+        for path in paths:
+            with open(path, 'rb') as f:
+                file_bytes = f.read()
+            files.append((file_bytes, content_hash(file_bytes)))
+        tables = load_pcc_tables(files, args.workers)
+        table = tables[0] if len(tables) == 1 else merge_pcc_tables(tables)
+        dataset = build_dataset(*table, file_hash=combined_hash([file_hash for _, file_hash in files]))
+        written = render_reports(dataset, os.path.join(args.output, "merged"), args.png, args.inline_js)
+    else:
+        written = []
+        with ProcessPoolExecutor(max_workers=min(len(paths), args.workers or os.cpu_count() or 1)) as pool:
+            futures = {path: pool.submit(_report_one_file, path, args.output, args.png, args.inline_js) for path in paths}
+            for path, future in futures.items():
+                try:
+                    written.extend(future.result())
+                except Exception as e:
+                    failed += 1
+                    print(f"❌ {os.path.basename(path)}: {e}", file=sys.stderr)
+        if failed:
+            print(f"{failed} of {len(paths)} exports failed", file=sys.stderr)
+
+    for path in written:
+        print(path)
+    # Any failed export fails the run, so scheduled jobs notice it
+    return 0 if written and not failed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
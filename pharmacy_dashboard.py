@@ -1,1262 +1,422 @@
-import streamlit as st
-import pandas as pd
-import re
-import plotly.express as px
-import plotly.graph_objects as go
-
-
-st.set_page_config(page_title="Pharmacy Service Dashboard", layout="wide")
-st.title("🏥 Pharmacy Service Performance Dashboard")
-
-uploaded_file = st.file_uploader("📤 Upload PCC Excel File", type=["xlsx"])
-
-if uploaded_file:
-    try:
-        raw_df = pd.read_excel(uploaded_file, sheet_name="Table 1", header=None)
-        header_row_index = raw_df[raw_df.apply(lambda row: row.astype(str).str.contains("Jan-24").any(), axis=1)].index[0]
-        
-        true_header = raw_df.iloc[header_row_index]
-        df = raw_df.iloc[header_row_index + 1:]
-        df.columns = true_header
-        df.reset_index(drop=True, inplace=True)
-        df.dropna(axis=1, how='all', inplace=True)
-        df.columns = df.columns.str.strip()
-        df.fillna('', inplace=True)
-
-        if 'JASMI LIMITED FRT03' in df.columns:
-            df['JASMI LIMITED FRT03'] = df['JASMI LIMITED FRT03'].astype(str)
-            df['JASMI LIMITED FRT03'] = df['JASMI LIMITED FRT03'].where(
-                ~df['JASMI LIMITED FRT03'].duplicated(),
-                df['JASMI LIMITED FRT03'] + '_' + df.groupby('JASMI LIMITED FRT03').cumcount().astype(str)
-            )
-
-        service_column = df.columns[0]
-
-        # st.subheader("🔍 Data Preview")
-        # st.dataframe(df)
-
-        month_pattern = re.compile(r'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)-\d{2}$')
-        months = [col for col in df.columns if isinstance(col, str) and month_pattern.match(col)]
-        for month in months:
-            df[month] = pd.to_numeric(df[month], errors='coerce')
-
-        def show_line_chart(title, keyword, col):
-            # Define target PCMs for specific services only
-            target_pcm_map = {
-                "P1 (NHS 111 & GP REFERRALS & CLIN PW)": 50,
-                "BLOOD PRESSURE": 30,
-                "ABPM":20,
-                "LFD":20,
-                "OC":20,
-                "DMS":20
-            }
-            
-            with col:
-                # st.markdown(f"### {title}")
-                rows = df[df[service_column].astype(str).str.strip().str.upper() == keyword.upper()]
-                if not rows.empty:
-                    chart_data = pd.DataFrame({'Month': months})
-                    chart_data['Month_dt'] = pd.to_datetime(chart_data['Month'], format='%b-%y')
-
-                    values = pd.to_numeric(rows.iloc[0][months], errors='coerce')
-                    chart_data['Value'] = values.values
-                    chart_data['Value'].fillna(0, inplace=True)
-                    chart_data = chart_data.sort_values('Month_dt')
-
-                    fig = px.line(
-                        chart_data,
-                        x='Month_dt',
-                        y='Value',
-                        title=title,
-                        markers=True,
-                        labels={'Month_dt': 'Month', 'Value': title}
-                    )
-
-                    # Add target PCM only for these 2 services
-                    target_pcm = target_pcm_map.get(keyword.upper())
-                    if target_pcm is not None:
-                        fig.add_hline(
-                            y=target_pcm,
-                            line_dash="dash",
-                            line_color="red",
-                            annotation_text=f"Target Performance = {target_pcm}",
-                            annotation_position="top left"
-                        )
-
-                    fig.update_layout(
-                        xaxis_tickformat='%b %y',
-                        xaxis=dict(
-                            tickmode='linear',
-                            dtick="M1"
-                        )
-                    )
-
-                    st.plotly_chart(fig, use_container_width=True)
-                else:
-                    st.warning(f"⚠️ {title} service not found.")
-
-
-
-        st.subheader("📊 Monthly Service Trends for Each Service – JASMI LIMITED (FRT03)")
-        col1, col2 = st.columns(2)
-        show_line_chart("NMS", "NMS", col1)
-        show_line_chart("Blood Pressure", "BLOOD PRESSURE", col2)
-
-        col3, col4 = st.columns(2)
-        show_line_chart("P1 (NHS 111 & GP Referrals & Clin PW)", "P1 (NHS 111 & GP REFERRALS & CLIN PW)", col3)
-        show_line_chart("ABPM", "ABPM", col4)
-
-        col5, col6 = st.columns(2)
-        show_line_chart("P1 Clinical Pathways", "P1 CLINICAL PATHWAYS", col5)
-        show_line_chart("Covid Vac (Total for season)", "COVID VAC (TOTAL FOR SEASON)", col6)
-
-        col7, col8 = st.columns(2)
-        show_line_chart("DMS", "DMS", col7)
-        show_line_chart("OC", "OC", col8)
-
-        col9, col10 = st.columns(2)
-        show_line_chart("Flu (Total for season)", "Flu (TOTAL FOR SEASON)", col9)
-        show_line_chart("LFD", "LFD", col10)
-
-
-#######Multi LIne CHart###########################################
-        # JASMI LIMITED FRT03 services to plot
-        multi_services = [
-            "NMS",
-            "BLOOD PRESSURE",
-            "P1 (NHS 111 & GP REFERRALS & CLIN PW)",
-            "P1 CLINICAL PATHWAYS",
-            "COVID VAC (TOTAL FOR SEASON)",
-            "Flu (TOTAL FOR SEASON)",
-            "ABPM",
-            "DMS",
-            "OC",
-            "LFD",
-            "CPCS"
-        ]
-
-        # Prepare long-format DataFrame
-        trend_rows = []
-        for service in multi_services:
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service.upper()]
-            if not row.empty:
-                values = pd.to_numeric(row.iloc[0][months], errors='coerce')
-                for month, value in zip(months, values):
-                    # Use regex to remove any _ followed by digits
-                    clean_label = re.sub(r'_\d+$', '', service).title()
-                    trend_rows.append({
-                        "Month": month,
-                        "Service": clean_label,  # 👈 Used in legend and tooltip
-                        "Value": value
-                    })
-
-        # Convert to DataFrame and format months
-        trend_df = pd.DataFrame(trend_rows)
-        trend_df["Month_dt"] = pd.to_datetime(trend_df["Month"], format="%b-%y")
-        trend_df.sort_values(by="Month_dt", inplace=True)
-
-        # Plot multi-line chart
-        fig = px.line(
-            trend_df,
-            x="Month_dt",
-            y="Value",
-            color="Service",
-            markers=True,
-            title="📈 Monthly Trends of All Services: JASMI LIMITED FRT03)",
-            labels={"Month_dt": "Month", "Value": "Count", "Service": "Service Type"},
-            width=1000,
-            height=600
-        )
-
-        fig.update_layout(
-            xaxis_tickformat="%b %y",
-            xaxis=dict(tickmode="linear", dtick="M1"),
-            legend_title_text="Service",
-            title_x=0.25,
-            margin=dict(l=20, r=20, t=60, b=40),
-            clickmode="event+select",
-            legend_itemclick="toggleothers",
-            legend_itemdoubleclick="toggle"
-        )
-
-        st.plotly_chart(fig, use_container_width=False)
-
-        # REVELSTOKE PHARMACY FE297 services to plot
-        multi_services = [
-            "NMS_1", 
-            "BLOOD PRESSURE_1",
-            "P1 (NHS 111 & GP REFERRALS & CLIN PW)_1",
-            "P1 CLINICAL PATHWAYS_1",
-            "COVID VAC (TOTAL FOR SEASON)_1",
-            "Flu (TOTAL FOR SEASON)",
-            "ABPM_1",
-            "DMS_1",
-            "OC_1",
-            "LFD_1",
-            "CPCS_1"
-        ]
-
-        # Prepare long-format DataFrame
-        trend_rows = []
-        for service in multi_services:
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service.upper()]
-            if not row.empty:
-                values = pd.to_numeric(row.iloc[0][months], errors='coerce')
-                for month, value in zip(months, values):
-                    # Use regex to remove any _ followed by digits
-                    clean_label = re.sub(r'_\d+$', '', service).title()
-                    trend_rows.append({
-                        "Month": month,
-                        "Service": clean_label,  # 👈 Used in legend and tooltip
-                        "Value": value
-                    })
-
-        # Convert to DataFrame and format months
-        trend_df_1 = pd.DataFrame(trend_rows)
-        trend_df_1["Month_dt"] = pd.to_datetime(trend_df_1["Month"], format="%b-%y")
-        trend_df_1.sort_values(by="Month_dt", inplace=True)
-
-        # Plot multi-line chart for _1 services
-        fig2 = px.line(
-            trend_df_1,
-            x="Month_dt",
-            y="Value",
-            color="Service",
-            markers=True,
-            title="📉 Monthly Trends of All Services: REVELSTOKE PHARMACY FE297",
-            labels={"Month_dt": "Month", "Value": "Count", "Service": "Service Type"},
-            width=1000,
-            height=600
-        )
-
-        fig2.update_layout(
-            xaxis_tickformat="%b %y",
-            xaxis=dict(tickmode="linear", dtick="M1"),
-            legend_title_text="Service",
-            title_x=0.25,
-            margin=dict(l=20, r=20, t=60, b=40),
-            clickmode="event+select",
-            legend_itemclick="toggleothers",
-            legend_itemdoubleclick="toggle"
-        )
-
-        st.plotly_chart(fig2, use_container_width=False)
-
-        # TRINITY PHARMACY FKP10 services to plot
-        multi_services = [
-            "NMS_2", 
-            "BLOOD PRESSURE_2",
-            "P1 (NHS 111 & GP REFERRALS)",
-            "P1 CLINICAL PATHWAYS_1",
-            "COVID VAC (TOTAL FOR SEASON)_1",
-            "Flu (TOTAL FOR SEASON)",
-            "ABPM_2",
-            "DMS_2",
-            "OC_2",
-            "LFD_2",
-            "CPCS_2"
-        ]
-
-        # Prepare long-format DataFrame
-        trend_rows = []
-        for service in multi_services:
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service.upper()]
-            if not row.empty:
-                values = pd.to_numeric(row.iloc[0][months], errors='coerce')
-                for month, value in zip(months, values):
-                    clean_label = re.sub(r'_\d+$', '', service).title()
-                    trend_rows.append({
-                        "Month": month,
-                        "Service": clean_label,  # 👈 Used in legend and tooltip
-                        "Value": value
-                    })
-
-        # Convert to DataFrame and format months
-        trend_df_1 = pd.DataFrame(trend_rows)
-        trend_df_1["Month_dt"] = pd.to_datetime(trend_df_1["Month"], format="%b-%y")
-        trend_df_1.sort_values(by="Month_dt", inplace=True)
-
-        # Plot multi-line chart for _1 services
-        fig2 = px.line(
-            trend_df_1,
-            x="Month_dt",
-            y="Value",
-            color="Service",
-            markers=True,
-            title="📉 Monthly Trends of All Services: TRINITY PHARMACY FKP10",
-            labels={"Month_dt": "Month", "Value": "Count", "Service": "Service Type"},
-            width=1000,
-            height=600
-        )
-
-        fig2.update_layout(
-            xaxis_tickformat="%b %y",
-            xaxis=dict(tickmode="linear", dtick="M1"),
-            legend_title_text="Service",
-            title_x=0.25,
-            margin=dict(l=20, r=20, t=60, b=40),
-            clickmode="event+select",
-            legend_itemclick="toggleothers",
-            legend_itemdoubleclick="toggle"
-        )
+import contextlib
+import json
+import os
+import sqlite3
+import uuid
 
-        st.plotly_chart(fig2, use_container_width=False)
-
-        # WOODBRIDGE PHARMACY FLD83 services to plot
-        multi_services = [
-            "NMS_3", 
-            "BLOOD PRESSURE_3",
-            "P1 (NHS 111 & GP REFERRALS)_1",
-            "P1 CLINICAL PATHWAYS_3",
-            "COVID VAC (TOTAL FOR SEASON)_3",
-            "Flu (TOTAL FOR SEASON)",
-            "ABPM_3",
-            "DMS_3",
-            "OC_3",
-            "LFD_3",
-            "CPCS_3"
-        ]
+import streamlit as st
 
-        # Prepare long-format DataFrame
-        trend_rows = []
-        for service in multi_services:
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service.upper()]
-            if not row.empty:
-                values = pd.to_numeric(row.iloc[0][months], errors='coerce')
-                for month, value in zip(months, values):
-                    clean_label = re.sub(r'_\d+$', '', service).title()
-                    trend_rows.append({
-                        "Month": month,
-                        "Service": clean_label,  # 👈 Used in legend and tooltip
-                        "Value": value
-                    })
-
-        # Convert to DataFrame and format months
-        trend_df_1 = pd.DataFrame(trend_rows)
-        trend_df_1["Month_dt"] = pd.to_datetime(trend_df_1["Month"], format="%b-%y")
-        trend_df_1.sort_values(by="Month_dt", inplace=True)
-
-        # Plot multi-line chart for _1 services
-        fig2 = px.line(
-            trend_df_1,
-            x="Month_dt",
-            y="Value",
-            color="Service",
-            markers=True,
-            title="📉 Monthly Trends of All Services: WOODBRIDGE PHARMACY FLD83",
-            labels={"Month_dt": "Month", "Value": "Count", "Service": "Service Type"},
-            width=1000,
-            height=600
-        )
+from dataset_cache import MAX_DATASET_BYTES, DatasetCache
+from fact_store import FactStore
+from figure_cache import FigureCache
+from figure_transport import compact_figure_json
+from instrumentation import Instrumentation
+from pcc_anomalies import dataset_anomalies
+from pcc_charts import (
+    WEBGL_POINT_THRESHOLD, compliance_heatmap_figure, history_figure, pcm_comparison_data, pcm_comparison_figure,
+    pharmacy_trends_figure, service_trend_figure
+)
+from pcc_kpis import KPI_LABELS, compliance_matrix
+from pcc_forecast import FORECAST_HORIZON, at_risk_table, dataset_forecast
+from pcc_history import append_exports, clear_history, history_hash, load_history, refresh_changes
+from pcc_loader import build_dataset, content_hash, load_pcc_table, load_pcc_tables
+from pcc_merge import combined_hash, merge_pcc_tables, month_sort_key
+from service_registry import SERVICES, build_service_table
 
-        fig2.update_layout(
-            xaxis_tickformat="%b %y",
-            xaxis=dict(tickmode="linear", dtick="M1"),
-            legend_title_text="Service",
-            title_x=0.25,
-            margin=dict(l=20, r=20, t=60, b=40),
-            clickmode="event+select",
-            legend_itemclick="toggleothers",
-            legend_itemdoubleclick="toggle"
-        )
 
-        st.plotly_chart(fig2, use_container_width=False)
+# Number of serialized figures kept across reruns and sessions
+MAX_CACHED_FIGURES = 512
 
+SECTIONS = ["Service Trends", "Pharmacy Trends", "Average PCM Comparison", "History Explorer"]
+ALL_SERVICES = "All services"
 
-#######BAR CHART###########################
+# Set PCC_INSTRUMENTATION=1 to turn the performance panel on by default
+INSTRUMENTATION_DEFAULT = os.environ.get("PCC_INSTRUMENTATION", "") not in ("", "0")
 
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 P1 (NHS 111 & GP referrals & Clin PW) Services: Average PCM Comparison")
 
-        # Mapping service keys to display names with pharmacy names
-        target_services = {
-            "P1 (NHS 111 & GP referrals & Clin PW)": "P1 (NHS 111 & GP referrals & Clin PW) (JASMI LIMITED FRT03)",
-            "P1 (NHS 111 & GP referrals & Clin PW)_1": "P1 (NHS 111 & GP referrals & Clin PW) (REVELSTOKE PHARMACY FE297)",
-            "P1 (NHS 111 & GP referrals)": "P1 (NHS 111 & GP referrals) (TRINITY PHARMACY FKP10)",
-            "P1 (NHS 111 & GP referrals)_1": "P1 (NHS 111 & GP referrals) (WOODBRIDGE PHARMACY FLD83)"
-        }
+@st.cache_resource
+def get_dataset_cache():
+    # Shared by every session in this server process, within PCC_DATASET_CACHE_MB
+    return DatasetCache(MAX_DATASET_BYTES)
 
-        # Define colors for each pharmacy display name — keys must exactly match the target_services values
-        color_map = {
-            "P1 (NHS 111 & GP referrals & Clin PW) (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "P1 (NHS 111 & GP referrals & Clin PW) (REVELSTOKE PHARMACY FE297)": "#FFD699", # Light Orange
-            "P1 (NHS 111 & GP referrals) (TRINITY PHARMACY FKP10)": "#A3C9F9",              # Light Blue
-            "P1 (NHS 111 & GP referrals) (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"            # Light Mint Green
-        }
 
+def load_shared_dataset(key, load, message):
+    # One read-only dataset per content hash for all sessions; only a cache miss shows a spinner
+    cache = get_dataset_cache()
+    with contextlib.nullcontext() if key in cache else st.spinner(message):
+        return cache.get_or_load(key, load)
 
-        threshold = 50
-        pcm_data = {}
 
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Status messages
-            for name, value in pcm_data.items():
-                if value < threshold:
-                    st.markdown(
-                        f"🔻 {name}: Underperforming (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f"<div style='color:green; font-weight:bold;'>🔺 {name}: Performing Well (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,  # fallback color if missing key
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.add_hline(
-                y=threshold,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Target Performance = {threshold}",
-                annotation_position="top left"
-            )
+def load_uploaded_dataset(files):
+    # Keyed on the content hashes only, so reruns on the same uploads skip parsing and merging
+    def load():
+        tables = load_pcc_tables(files)
+        table = tables[0] if len(tables) == 1 else merge_pcc_tables(tables)
+        return build_dataset(*table, file_hash=key)
 
-            fig.update_traces(textposition="outside")
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=1100,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
+    key = combined_hash([file_hash for _, file_hash in files])
+    return load_shared_dataset(key, load, "Reading PCC workbooks...")
 
-            st.plotly_chart(fig, use_container_width=False)
 
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
+def load_history_dataset(history_key):
+    # history_key changes whenever an export is applied, so an outdated history is never reused
+    def load():
+        table = load_history()
+        if table is None:
+            raise ValueError("The stored history is missing; upload the exports again to rebuild it.")
+        return build_dataset(*table, file_hash=history_key)
 
+    return load_shared_dataset(history_key, load, "Loading stored history...")
 
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 Blood Pressure Services: Average PCM Comparison")
 
-        # Mapping service keys to display names with pharmacy names
-        target_services = {
-            "Blood Pressure": "Blood Pressure (JASMI LIMITED FRT03)",
-            "Blood Pressure_1": "Blood Pressure (REVELSTOKE PHARMACY FE297)",
-            "Blood Pressure_2": "Blood Pressure (TRINITY PHARMACY FKP10)",
-            "Blood Pressure_3": "Blood Pressure (WOODBRIDGE PHARMACY FLD83)"
-        }
+def load_derived(name, dataset, build):
+    # The service table, forecasts and anomaly flags are derived once per dataset, shared
+    # read-only like the dataset and counted against the same memory budget
+    return get_dataset_cache().get_or_load((name, dataset.file_hash), build)
 
-        # Define colors for each pharmacy display name — keys must match the values from target_services exactly
-        color_map = {
-            "Blood Pressure (JASMI LIMITED FRT03)": "#FFB3B3",       # Soft Red
-            "Blood Pressure (REVELSTOKE PHARMACY FE297)": "#FFE0B2", # Soft Orange/Peach
-            "Blood Pressure (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "Blood Pressure (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Mint Green
-        }
 
+def load_service_table(dataset):
+    # Every pharmacy's services resolved to canonical keys in one join, once per dataset
+    return load_derived("service_table", dataset, lambda: build_service_table(dataset))
 
-        threshold = 30
-        pcm_data = {}
 
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Status messages
-            for name, value in pcm_data.items():
-                if value < threshold:
-                    st.markdown(
-                        f"🔻 {name}: Underperforming (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f"<div style='color:green; font-weight:bold;'>🔺 {name}: Performing Well (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.add_hline(
-                y=threshold,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Target Performance = {threshold}",
-                annotation_position="top left"
-            )
+def load_forecast(dataset, service_table):
+    # Every series of the dataset is forecast in one batch, once per dataset
+    return load_derived("forecast", dataset, lambda: dataset_forecast(dataset, service_table['position']))
 
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
 
-            st.plotly_chart(fig, use_container_width=False)
+def load_anomalies(dataset, service_table):
+    return load_derived("anomalies", dataset, lambda: dataset_anomalies(dataset, service_table))
 
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected Blood Pressure services.")
 
+@st.cache_resource
+def get_fact_store():
+    return FactStore()
 
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 DMS Services: Average PCM Comparison")
 
+@st.cache_resource
+def get_figure_cache():
+    # Shared by every session in this server process; figures are stored in their compact
+    # browser-ready form
+    return FigureCache(MAX_CACHED_FIGURES, serialize=compact_figure_json)
 
-        # Service mapping
-        target_services = {
-            "DMS": "DMS (JASMI LIMITED FRT03)",
-            "DMS_1": "DMS (REVELSTOKE PHARMACY FE297)",
-            "DMS_2": "DMS (TRINITY PHARMACY FKP10)",
-            "DMS_3": "DMS (WOODBRIDGE PHARMACY FLD83)"
-        }
 
-        # Fixed color map
-        color_map = {
-            "DMS (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "DMS (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "DMS (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "DMS (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
+def cached_figure(dataset, chart_type, build, service=None, pharmacy=None, target=None):
+    key = (dataset.file_hash, service, pharmacy, chart_type, target)
+    with perf.stage("figure", chart_type=chart_type):
+        return get_figure_cache().get_or_build(key, build)
 
-        threshold = 20
-        pcm_data = {}
 
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Status messages
-            for name, value in pcm_data.items():
-                if value < threshold:
-                    st.markdown(
-                        f"🔻 {name}: Underperforming (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f"<div style='color:green; font-weight:bold;'>🔺 {name}: Performing Well (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,  # group by service
-                    showlegend=True
-                ))
-
-            fig.add_hline(
-                y=threshold,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Target Performance = {threshold}",
-                annotation_position="top left"
-            )
+def show_figure(fig, use_container_width):
+    # Serializing the figure into the page is timed separately from building it
+    with perf.stage("plotly_chart"):
+        if perf.enabled:
+            perf.count("bytes", len(json.dumps(fig, separators=(',', ':'))))
+        st.plotly_chart(fig, use_container_width=use_container_width)
 
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
 
-            st.plotly_chart(fig, use_container_width=False)
+def show_history_changes(log, refreshes):
+    if refreshes:
+        new_months = sorted({month for refresh in refreshes for month in refresh['new_months']}, key=month_sort_key)
+        st.success(
+            f"📚 Added {len(refreshes)} export(s) to the stored history"
+            + (f": new months {', '.join(new_months)}." if new_months else ".")
+        )
 
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-        
-
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 ABPM Services: Average PCM Comparison")
-
-        # Service mapping
-        target_services = {
-            "ABPM": "ABPM (JASMI LIMITED FRT03)",
-            "ABPM_1": "ABPM (REVELSTOKE PHARMACY FE297)",
-            "ABPM_2": "ABPM (TRINITY PHARMACY FKP10)",
-            "ABPM_3": "ABPM (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "ABPM (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "ABPM (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "ABPM (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "ABPM (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                pcm_raw = row.iloc[0].get("Average PCM", "")
-                if pcm_raw not in ['', None]:
-                    try:
-                        pcm = float(pcm_raw)
-                        if pcm >= 0:  # Only include non-negative values
-                            pcm_data[service_display] = round(pcm)
-                        else:
-                            st.warning(f"⚠️ Negative PCM value for {service_display} ignored.")
-                    except ValueError:
-                        st.warning(f"⚠️ Invalid PCM value for {service_display}: {pcm_raw}")
-
-        if pcm_data:
-            y_values = list(pcm_data.values())
-            max_y = max(y_values)
-
-            # Set y-axis range only if there are non-zero values
-            yaxis_range = [0, max_y + 10] if max_y > 0 else [0, 1]
-
-            # Display service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map.get(service, "#CCCCCC"),
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                yaxis=dict(range=yaxis_range),
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
+    with st.expander(f"🧾 Stored history: {len(log['applied'])} export(s) applied", expanded=False):
+        summary = [
+            {
+                "Applied": refresh['applied_at'],
+                "New months": ", ".join(refresh['new_months']),
+                "Cells added": refresh['added'],
+                "Cells revised": refresh['revised'],
+                "New series": refresh['new_series']
+            }
+            for refresh in reversed(log['refreshes'])
+        ]
+        st.dataframe(summary, hide_index=True, use_container_width=True)
+        if log['refreshes']:
+            st.caption("Cells changed by the latest export")
+            st.dataframe(refresh_changes(log['refreshes'][-1]), hide_index=True, use_container_width=True)
+
+
+def show_history_explorer():
+    # Every upload so far, queried from the fact store with the filters and aggregates in SQL
+    store = get_fact_store()
+    months = store.months()
+    if months.empty:
+        st.info("The fact store is empty.")
+        return
+
+    spec = st.sidebar.selectbox("🩺 Service", SERVICES, format_func=lambda spec: spec.label)
+    pharmacies = store.pharmacies()
+    selected = st.sidebar.multiselect(
+        "🏪 Pharmacies", pharmacies['code'], format_func=dict(zip(pharmacies['code'], pharmacies['name'])).get,
+        placeholder="All pharmacies"
+    )
+    start, end = (months[0], months[-1]) if len(months) == 1 else st.sidebar.select_slider(
+        "📅 Months", options=list(months), value=(months[0], months[-1]), format_func=lambda month: month.strftime('%b %y')
+    )
+
+    st.subheader(f"🗄️ {spec.label} History – {start:%b %y} to {end:%b %y}")
+    series = store.series(spec.key, selected, start, end)
+    if series.empty:
+        st.warning(f"⚠️ No {spec.label} values stored for this selection.")
+        return
+
+    # Not cached, since the store changes with every upload, but sent in the same compact form
+    show_figure(json.loads(compact_figure_json(history_figure(series, spec.label, spec.target))), use_container_width=True)
+    summary = store.summary(spec.key, selected, start, end)
+    st.dataframe(
+        summary.rename(columns={
+            'pharmacy_name': "Pharmacy", 'months': "Months", 'total': "Total", 'average': "Average",
+            'minimum': "Min", 'maximum': "Max", 'first_month': "From", 'last_month': "To"
+        }).round(1),
+        hide_index=True,
+        use_container_width=True
+    )
+    stats = store.stats()
+    st.caption(
+        f"Fact store: {stats['facts']:,} values from {stats['uploads']} upload(s) across "
+        f"{stats['pharmacies']} pharmacies · {stats['bytes'] / 2**20:.1f} MiB"
+    )
+
+
+def show_instrumentation_panel():
+    total_ms = perf.finish()
+    if total_ms is None:
+        return
+    with st.expander(f"🐞 Performance: {total_ms:.0f} ms this rerun", expanded=False):
+        st.dataframe(perf.records, use_container_width=True)
+
+
+def show_line_chart(dataset, rows, spec, pharmacy, col, forecast, anomalies, full_resolution=False):
+    with col:
+        if not rows.empty:
+            fig = cached_figure(
+                dataset, "trend_full" if full_resolution else "trend",
+                lambda: service_trend_figure(
+                    dataset.facts_at(rows['position']), spec.label, spec.target, full_resolution,
+                    forecast[forecast['position'].isin(rows['position'])],
+                    anomalies[anomalies['position'].isin(rows['position'])]
+                ),
+                service=spec.key, pharmacy=pharmacy.code, target=spec.target
             )
-
-            st.plotly_chart(fig, use_container_width=True)
-
+            show_figure(fig, use_container_width=True)
         else:
-            st.warning("⚠️ No valid (non-negative) Average PCM values found for selected P1 services.")
-
-
-        
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 OC Services: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "OC": "OC (JASMI LIMITED FRT03)",
-            "OC_1": "OC (REVELSTOKE PHARMACY FE297)",
-            "OC_2": "OC (TRINITY PHARMACY FKP10)",
-            "OC_3": "OC (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "OC (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "OC (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "OC (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "OC (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
+            st.warning(f"⚠️ {spec.label} service not found.")
+
+
+def show_compliance(dataset, service_table, service_specs):
+    # One heatmap of every pharmacy's monthly values against target for the selected services
+    keys = tuple(spec.key for spec in service_specs if spec.target is not None)
+    if not keys:
+        return
+    rows = service_table[service_table['service'].isin(keys)]
+    if rows.empty:
+        return
+    fig = cached_figure(
+        dataset, "compliance",
+        lambda: compliance_heatmap_figure(compliance_matrix(dataset, rows)),
+        service=keys
+    )
+    show_figure(fig, use_container_width=True)
+
+
+def show_anomalies(anomalies):
+    if anomalies.empty:
+        return
+    counts = anomalies['kind'].value_counts()
+    with st.expander(
+        f"🚩 {len(anomalies)} flagged data points: " + ", ".join(f"{count} {kind}" for kind, count in counts.items()),
+        expanded=False
+    ):
+        st.dataframe(
+            anomalies[['pharmacy_name', 'label', 'Month_dt', 'value', 'kind', 'score']].rename(columns={
+                'pharmacy_name': "Pharmacy", 'label': "Service", 'Month_dt': "Month", 'value': "Value",
+                'kind': "Flag", 'score': "Score"
+            }).round({"Score": 2}),
+            hide_index=True,
+            use_container_width=True,
+            column_config={"Month": st.column_config.DateColumn(format="MMM YY")}
+        )
 
-        threshold = 20
-        pcm_data = {}
 
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Status messages
-            for name, value in pcm_data.items():
-                if value < threshold:
-                    st.markdown(
-                        f"🔻 {name}: Underperforming (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-                else:
-                    st.markdown(
-                        f"<div style='color:green; font-weight:bold;'>🔺 {name}: Performing Well (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,  # group by service
-                    showlegend=True
-                ))
-
-            fig.add_hline(
-                y=threshold,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Target Performance = {threshold}",
-                annotation_position="top left"
-            )
+def show_at_risk(service_table, service_specs, forecast):
+    at_risk = at_risk_table(service_table[service_table['service'].isin([spec.key for spec in service_specs])], forecast)
+    if at_risk.empty:
+        return
+    st.subheader(f"🚨 At Risk of Missing Target – Next {FORECAST_HORIZON} Months")
+    st.dataframe(
+        at_risk[['display', 'target', 'avg_3m', 'forecast', 'lower', 'upper', 'gap', 'likely']].rename(columns={
+            'display': "Service", 'target': "Target", 'avg_3m': "Last 3 months", 'forecast': "Projected",
+            'lower': "Low", 'upper': "High", 'gap': "Gap", 'likely': "Likely miss"
+        }).round(1),
+        hide_index=True,
+        use_container_width=True
+    )
+    st.caption(f"Projected with {forecast['method'].iloc[0].replace('_', ' ')}; Low–High is an ~80% band.")
+
+
+def show_pcm_comparison(dataset, service_specs, service_table):
+    st.subheader("📊 Average PCM Comparison")
+
+    keys = tuple(spec.key for spec in service_specs)
+    rows = service_table[service_table['service'].isin(keys)]
+    valid_rows, negative = pcm_comparison_data(rows)
+    for name in negative:
+        st.warning(f"⚠️ Negative PCM value for {name} ignored.")
+    for row in rows[rows['pcm_mismatch']].itertuples():
+        st.warning(
+            f"⚠️ {row.display}: the export's Average PCM is {row.average_pcm:g} "
+            f"but its monthly values average {row.mean_pcm:.1f}."
+        )
+    for spec in service_specs:
+        if not (valid_rows['service'] == spec.key).any():
+            st.warning(f"⚠️ No valid Average PCM values found for selected {spec.label} services.")
+
+    if valid_rows.empty:
+        return
+
+    fig = cached_figure(
+        dataset, "pcm_comparison",
+        lambda: pcm_comparison_figure(valid_rows, [(spec.key, spec.label, spec.target) for spec in service_specs]),
+        service=keys
+    )
+    show_figure(fig, use_container_width=True)
+
+    with st.expander("📋 KPIs", expanded=False):
+        st.dataframe(
+            rows[['display', *KPI_LABELS]].rename(columns={'display': "Service", **KPI_LABELS}).round(1),
+            hide_index=True,
+            use_container_width=True
+        )
 
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
 
-            st.plotly_chart(fig, use_container_width=False)
+st.set_page_config(page_title="Pharmacy Service Dashboard", layout="wide")
+st.title("🏥 Pharmacy Service Performance Dashboard")
 
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-        
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 LFD Services: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "LFD": "LFD (JASMI LIMITED FRT03)",
-            "LFD_1": "LFD (REVELSTOKE PHARMACY FE297)",
-            "LFD_2": "LFD (TRINITY PHARMACY FKP10)",
-            "LFD_3": "LFD (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "LFD (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "LFD (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "LFD (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "LFD (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-        threshold = 20
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
+perf = Instrumentation(
+    enabled=st.sidebar.checkbox("🐞 Performance instrumentation", value=INSTRUMENTATION_DEFAULT),
+    session=st.session_state.setdefault("perf_session", uuid.uuid4().hex[:8])
+)
+
+# Reruns and st.stop() raise BaseExceptions past the handler below; tracemalloc must still be
+# released when they do
+try:
+    use_history = st.sidebar.checkbox(
+        "📚 Add uploads to stored history",
+        help="Apply each new export to the dataset kept on the server, updating only the months it adds or revises."
+    )
+    if use_history and st.sidebar.button("🗑️ Clear stored history"):
+        clear_history()
+
+    uploaded_files = st.file_uploader("📤 Upload PCC Excel Files", type=["xlsx"], accept_multiple_files=True)
+
+    if uploaded_files:
+        try:
+            files = [(file_bytes, content_hash(file_bytes)) for file_bytes in (f.getvalue() for f in uploaded_files)]
+            if use_history:
+                with perf.stage("history_append", files=len(files)):
+                    log, refreshes = append_exports(files, load_pcc_table)
+                with perf.stage("load_dataset"):
+                    dataset = load_history_dataset(history_hash(log))
+                show_history_changes(log, refreshes)
+            else:
+                with perf.stage("load_dataset", files=len(files)):
+                    dataset = load_uploaded_dataset(files)
+            if len(files) > 1 and not use_history:
+                st.caption(f"Merged {len(files)} exports covering {dataset.months[0]} – {dataset.months[-1]}.")
+            with perf.stage("fact_store"):
                 try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Status messages
-            for name, value in pcm_data.items():
-                if value < threshold:
-                    st.markdown(
-                        f"🔻 {name}: Underperforming (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
+                    get_fact_store().ingest(dataset)
+                except (OSError, sqlite3.Error) as e:
+                    st.warning(f"⚠️ Could not add this upload to the fact store: {e}")
+            with perf.stage("service_table"):
+                service_table = load_service_table(dataset)
+            with perf.stage("forecast"):
+                forecast = load_forecast(dataset, service_table)
+            with perf.stage("anomalies"):
+                anomalies = load_anomalies(dataset, service_table)
+            show_anomalies(anomalies)
+            rows_by_service = {key: rows for key, rows in service_table.groupby('service', sort=False)}
+            empty_rows = service_table.iloc[0:0]
+
+            # Only the section picked here is built and sent to the browser on each rerun
+            section = st.sidebar.radio("📂 Section", SECTIONS)
+            if section in ("Service Trends", "Pharmacy Trends"):
+                pharmacy = st.sidebar.selectbox("🏪 Pharmacy", dataset.pharmacies, format_func=lambda p: p.name)
+            if section in ("Service Trends", "Average PCM Comparison"):
+                service_specs = SERVICES if section == "Average PCM Comparison" else [spec for spec in SERVICES if spec.show_trend]
+                selected = st.sidebar.selectbox("🩺 Service", [ALL_SERVICES] + [spec.label for spec in service_specs])
+                if selected != ALL_SERVICES:
+                    service_specs = [spec for spec in service_specs if spec.label == selected]
+
+            # Long histories are drawn with WebGL and downsampled unless full resolution is asked for
+            full_resolution = False
+            if section in ("Service Trends", "Pharmacy Trends") and len(dataset.months) * len(SERVICES) > WEBGL_POINT_THRESHOLD:
+                full_resolution = st.sidebar.checkbox(
+                    "🔍 Full resolution charts", value=False,
+                    help="Send every month to the browser instead of a downsampled overview."
+                )
+
+            if section == "Service Trends":
+                st.subheader(f"📊 Monthly Service Trends for Each Service – {pharmacy.name}")
+                for i in range(0, len(service_specs), 2):
+                    for spec, col in zip(service_specs[i:i + 2], st.columns(2)):
+                        rows = rows_by_service.get(spec.key, empty_rows)
+                        with perf.stage(f"trend:{spec.key}", pharmacy=pharmacy.code):
+                            show_line_chart(
+                                dataset, rows[rows['pharmacy'] == pharmacy.code], spec, pharmacy, col, forecast,
+                                anomalies, full_resolution
+                            )
+
+            elif section == "Pharmacy Trends":
+                positions = service_table.loc[service_table['pharmacy'] == pharmacy.code, 'position']
+                if not positions.empty:
+                    with perf.stage(f"pharmacy_trends:{pharmacy.code}"):
+                        fig = cached_figure(
+                            dataset, "pharmacy_trends_full" if full_resolution else "pharmacy_trends",
+                            # Slice this pharmacy's services out of the long-format fact table
+                            lambda: pharmacy_trends_figure(
+                                dataset.facts_at(positions), pharmacy.name, full_resolution,
+                                anomalies[anomalies['position'].isin(positions)]
+                            ),
+                            pharmacy=pharmacy.code
+                        )
+                        show_figure(fig, use_container_width=False)
                 else:
-                    st.markdown(
-                        f"<div style='color:green; font-weight:bold;'>🔺 {name}: Performing Well (Average PCM = {value})</div>",
-                        unsafe_allow_html=True
-                    )
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,  # group by service
-                    showlegend=True
-                ))
-
-            fig.add_hline(
-                y=threshold,
-                line_dash="dash",
-                line_color="red",
-                annotation_text=f"Target Performance = {threshold}",
-                annotation_position="top left"
-            )
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-        
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 CPCS Services: Average PCM Comparison")
-
-        # Service mapping
-        target_services = {
-            "CPCS": "CPCS (JASMI LIMITED FRT03)",
-            "CPCS_1": "CPCS (REVELSTOKE PHARMACY FE297)",
-            "CPCS_2": "CPCS (TRINITY PHARMACY FKP10)",
-            "CPCS_3": "CPCS (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "CPCS (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "CPCS (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "CPCS (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "CPCS (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Just show service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-
-        
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 Flu (TOTAL FOR SEASON) Services: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "Flu (Total for season)": "Flu (Total for season) (JASMI LIMITED FRT03)",
-            "Flu (Total for season)_1": "Flu (Total for season) (REVELSTOKE PHARMACY FE297)",
-            "Flu (Total for season)_2": "Flu (Total for season) (TRINITY PHARMACY FKP10)",
-            "Flu (Total for season)_3": "Flu (Total for season) (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "Flu (Total for season) (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "Flu (Total for season) (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "Flu (Total for season) (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "Flu (Total for season) (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Just show service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=1000,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-        
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 Covid Vac (Total for season) Services: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "Covid Vac (Total for season)": "Covid Vac (Total for season) (JASMI LIMITED FRT03)",
-            "Covid Vac (Total for season)_1": "Covid Vac (Total for season) (REVELSTOKE PHARMACY FE297)",
-            "Covid Vac (Total for season)_2": "Covid Vac (Total for season) (TRINITY PHARMACY FKP10)",
-            "Covid Vac (Total for season)_3": "Covid Vac (Total for season) (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "Covid Vac (Total for season) (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "Covid Vac (Total for season) (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "Covid Vac (Total for season) (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "Covid Vac (Total for season) (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Just show service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=1100,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 NMS Services: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "NMS": "NMS (JASMI LIMITED FRT03)",
-            "NMS_1": "NMS (REVELSTOKE PHARMACY FE297)",
-            "NMS_2": "NMS (TRINITY PHARMACY FKP10)",
-            "NMS_3": "NMS (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "NMS (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "NMS (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "NMS (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "NMS (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Just show service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=800,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-
-        # Mapping service keys to display names with pharmacy names
-        st.subheader("📊 P1 Clinical Pathways: Average PCM Comparison")
-
-
-        # Service mapping
-        target_services = {
-            "P1 Clinical Pathways": "P1 Clinical Pathways (JASMI LIMITED FRT03)",
-            "P1 Clinical Pathways_1": "P1 Clinical Pathways (REVELSTOKE PHARMACY FE297)",
-            "P1 Clinical Pathways_2": "P1 Clinical Pathways (TRINITY PHARMACY FKP10)",
-            "P1 Clinical Pathways_3": "P1 Clinical Pathways (WOODBRIDGE PHARMACY FLD83)"
-        }
-
-        # Fixed color map
-        color_map = {
-            "P1 Clinical Pathways (JASMI LIMITED FRT03)": "#FFB3B3",       # Light Red
-            "P1 Clinical Pathways (REVELSTOKE PHARMACY FE297)": "#FFD580", # Light Orange
-            "P1 Clinical Pathways (TRINITY PHARMACY FKP10)": "#A3C9F9",    # Light Blue
-            "P1 Clinical Pathways (WOODBRIDGE PHARMACY FLD83)": "#B0EACD"  # Light Green
-        }
-
-        pcm_data = {}
-
-        for service_key, service_display in target_services.items():
-            row = df[df[service_column].astype(str).str.strip().str.upper() == service_key.upper()]
-            if not row.empty:
-                try:
-                    pcm_raw = row.iloc[0].get("Average PCM", "")
-                    if pcm_raw != '':
-                        pcm = round(float(pcm_raw))
-                        pcm_data[service_display] = pcm
-                except:
-                    pass
-
-        if pcm_data:
-            # Just show service name and value
-            for name, value in pcm_data.items():
-                st.markdown(f"📌 {name}: Average PCM = {value}")
-
-            # Custom bar chart
-            fig = go.Figure()
-
-            for service, pcm in pcm_data.items():
-                fig.add_trace(go.Bar(
-                    x=[service],
-                    y=[pcm],
-                    name=service,
-                    marker_color=color_map[service],
-                    marker_line_color='black',
-                    marker_line_width=1.2,
-                    text=[pcm],
-                    textposition="outside",
-                    legendgroup=service,
-                    showlegend=True
-                ))
-
-            fig.update_layout(
-                xaxis_tickangle=-45,
-                width=1000,
-                height=700,
-                margin=dict(l=20, r=20, t=40, b=20),
-                showlegend=True,
-                clickmode="event+select",
-                legend_itemclick="toggleothers",
-                legend_itemdoubleclick="toggle"
-            )
-
-            st.plotly_chart(fig, use_container_width=False)
-
-        else:
-            st.warning("⚠️ No valid Average PCM values found for selected P1 services.")
-
-
-
-    except Exception as e:
-        st.error(f"❌ An error occurred: {e}")
-else:
-    st.info("👈 Please upload a file to begin analysis.")
+                    st.warning(f"⚠️ No services found for {pharmacy.name}.")
+
+            elif section == "Average PCM Comparison":
+                with perf.stage("compliance"):
+                    show_compliance(dataset, service_table, service_specs)
+                with perf.stage("at_risk"):
+                    show_at_risk(service_table, service_specs, forecast)
+                with perf.stage("pcm_comparison"):
+                    show_pcm_comparison(dataset, service_specs, service_table)
+
+            else:
+                with perf.stage("history_explorer"):
+                    show_history_explorer()
+
+            with st.sidebar.expander("🧠 Caches"):
+                stats = get_figure_cache().stats()
+                st.caption(
+                    f"Figures – Hits: {stats['hits']} · Misses: {stats['misses']} · Hit rate: {stats['hit_rate']:.0%} · "
+                    f"Entries: {stats['entries']}/{stats['max_entries']} · Size: {stats['bytes'] / 1024:.0f} KB"
+                )
+                stats = get_dataset_cache().stats()
+                st.caption(
+                    f"Datasets – Hits: {stats['hits']} · Misses: {stats['misses']} · Evictions: {stats['evictions']} · "
+                    f"Entries: {stats['entries']} · Size: {stats['bytes'] / 2**20:.1f}/{stats['max_bytes'] / 2**20:.0f} MiB"
+                )
+
+        except Exception as e:
+            st.error(f"❌ An error occurred: {e}")
+    else:
+        st.info("👈 Please upload a file to begin analysis.")
+
+    show_instrumentation_panel()
+finally:
+    perf.finish()
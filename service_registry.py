@@ -0,0 +1,105 @@
+from dataclasses import dataclass
+
+import pandas as pd
+
+from pcc_kpis import dataset_kpis
+from pcc_loader import normalize_service_key, strip_dedup_suffix
+
+
+@dataclass(frozen=True)
+class ServiceSpec:
+    key: str
+    label: str
+    # Other labels the same service is reported under by some pharmacies
+    aliases: tuple = ()
+    # Target Average PCM; None means the service is shown without a target line
+    target: int = None
+    show_trend: bool = True
+
+    @property
+    def sheet_labels(self):
+        return (self.label,) + self.aliases
+
+
+# Every section of the dashboard is driven from this list, in this order
+SERVICES = [
+    ServiceSpec("NMS", "NMS"),
+    ServiceSpec("BP", "Blood Pressure", target=30),
+    ServiceSpec(
+        "P1",
+        "P1 (NHS 111 & GP referrals & Clin PW)",
+        aliases=("P1 (NHS 111 & GP referrals)",),
+        target=50
+    ),
+    ServiceSpec("P1_CP", "P1 Clinical Pathways"),
+    ServiceSpec("COVID", "Covid Vac (Total for season)"),
+    ServiceSpec("FLU", "Flu (Total for season)"),
+    ServiceSpec("ABPM", "ABPM", target=20),
+    ServiceSpec("DMS", "DMS", target=20),
+    ServiceSpec("OC", "OC", target=20),
+    ServiceSpec("LFD", "LFD", target=20),
+    ServiceSpec("CPCS", "CPCS", show_trend=False),
+]
+
+SERVICES_BY_KEY = {service.key: service for service in SERVICES}
+
+
+def service_alias_key(label):
+    # Normalization rule shared by the registry and the sheets: surrounding whitespace, case
+    # and the _N de-dup suffixes given to repeated labels are ignored
+    return normalize_service_key(strip_dedup_suffix(label))
+
+
+def compile_aliases(services):
+    # The alias table, indexed by normalized sheet label: the canonical service key, the
+    # label's preference within that service (its main label first) and the service's place
+    # in the registry. A label may only ever name one service
+    records = [
+        (service_alias_key(label), spec.key, rank, order)
+        for order, spec in enumerate(services)
+        for rank, label in enumerate(spec.sheet_labels)
+    ]
+    aliases = pd.DataFrame.from_records(records, columns=['alias', 'service', 'rank', 'order'])
+    services_per_alias = aliases.groupby('alias')['service'].nunique()
+    conflicts = services_per_alias.index[services_per_alias > 1]
+    if len(conflicts):
+        raise ValueError(f"Sheet labels listed under more than one service: {', '.join(conflicts)}")
+    return aliases.drop_duplicates('alias').set_index('alias')
+
+
+# Compiled once at import; every section resolves services through this lookup
+SERVICE_ALIASES = compile_aliases(SERVICES)
+
+# Bar colours assigned to pharmacies in the order their blocks appear in the sheet
+PHARMACY_COLORS = [
+    "#FFB3B3",  # Light Red
+    "#FFD580",  # Light Orange
+    "#A3C9F9",  # Light Blue
+    "#B0EACD",  # Light Mint Green
+    "#D7BDE2",  # Lavender
+    "#F9E79F",  # Pale Yellow
+    "#F5B7B1",  # Rose
+    "#A2D9CE",  # Aqua
+    "#FAD7A0",  # Apricot
+    "#D5DBDB"   # Light Grey
+]
+
+
+def pharmacy_color(index):
+    return PHARMACY_COLORS[index % len(PHARMACY_COLORS)]
+
+
+def build_service_table(dataset):
+    # Every registry service resolved for every pharmacy in one pass, with bar labels and colours
+    service_table = dataset.service_table(SERVICE_ALIASES)
+    pharmacy_order = {pharmacy.code: i for i, pharmacy in enumerate(dataset.pharmacies)}
+    service_table['display'] = service_table['label'] + " (" + service_table['pharmacy_name'] + ")"
+    service_table['color'] = service_table['pharmacy'].map(lambda code: pharmacy_color(pharmacy_order[code]))
+    service_table['target'] = service_table['service'].map(lambda key: SERVICES_BY_KEY[key].target).astype(float)
+
+    # KPIs are recomputed from the month columns; the export's own "Average PCM" is only used
+    # where a service has no monthly values at all
+    kpis = dataset_kpis(dataset, service_table['position'].tolist(), service_table['average_pcm'])
+    service_table = pd.concat([service_table, kpis.set_axis(service_table.index)], axis=1)
+    service_table['pcm'] = service_table['mean_pcm'].fillna(service_table['average_pcm'])
+    return service_table
@@ -0,0 +1,118 @@
+import json
+import os
+
+import pyarrow as pa
+
+
+# Normalized PCC tables are kept on disk as uncompressed Arrow IPC files so later loads can
+# memory-map them instead of going back through openpyxl
+SNAPSHOT_DIR = os.environ.get(
+    "PCC_SNAPSHOT_DIR",
+    os.path.join(os.path.expanduser("~"), ".cache", "pharmacy_dashboard", "snapshots")
+)
+MAX_SNAPSHOT_BYTES = int(os.environ.get("PCC_SNAPSHOT_MAX_MB", "512")) * 1024 * 1024
+
+# Bump whenever the normalized table layout changes so stale snapshots are never read back
+SNAPSHOT_VERSION = 5
+SNAPSHOT_SUFFIX = f".v{SNAPSHOT_VERSION}.arrow"
+
+
+def snapshot_path(file_hash, snapshot_dir=None):
+    return os.path.join(snapshot_dir or SNAPSHOT_DIR, file_hash + SNAPSHOT_SUFFIX)
+
+
+def load_snapshot(file_hash, snapshot_dir=None):
+    path = snapshot_path(file_hash, snapshot_dir)
+    if not os.path.exists(path):
+        return None
+
+    try:
+        with pa.memory_map(path, 'r') as source:
+            table = pa.ipc.open_file(source).read_all()
+        meta = json.loads(table.schema.metadata[b'pcc'])
+        df = table.to_pandas()
+    except (OSError, KeyError, ValueError, pa.ArrowInvalid):
+        # Unreadable or foreign file: drop it and fall back to parsing the workbook
+        _remove_quietly(path)
+        return None
+
+    # Column labels are stored separately because headers may be blank or repeated
+    df.columns = [name if name is not None else float('nan') for name in meta['columns']]
+
+    # Touch the file so pruning treats it as recently used
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+    return df, df.columns[meta['service_column_index']], meta['months']
+
+
+def save_snapshot(file_hash, df, service_column, months, snapshot_dir=None, max_bytes=None, prune=True):
+    # prune=False writes outside the size-capped cache, for tables that must not be evicted
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    path = snapshot_path(file_hash, snapshot_dir)
+
+    meta = {
+        'columns': [col if isinstance(col, str) else None for col in df.columns],
+        'service_column_index': list(df.columns).index(service_column),
+        'months': months
+    }
+
+    positional = df.copy()
+    positional.columns = [f"c{i}" for i in range(df.shape[1])]
+    table = pa.Table.from_pandas(positional, preserve_index=False)
+    table = table.replace_schema_metadata({**(table.schema.metadata or {}), b'pcc': json.dumps(meta).encode()})
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(snapshot_dir, exist_ok=True)
+        with pa.OSFile(tmp_path, 'wb') as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(tmp_path, path)
+    except OSError:
+        # A read-only or full disk only costs us the snapshot, never the upload
+        _remove_quietly(tmp_path)
+        return False
+
+    if prune:
+        prune_snapshots(snapshot_dir, max_bytes)
+    return True
+
+
+def prune_snapshots(snapshot_dir=None, max_bytes=None):
+    # Evict least recently used snapshots until the store fits under the size cap
+    snapshot_dir = snapshot_dir or SNAPSHOT_DIR
+    max_bytes = MAX_SNAPSHOT_BYTES if max_bytes is None else max_bytes
+
+    try:
+        names = [name for name in os.listdir(snapshot_dir) if name.endswith('.arrow')]
+    except OSError:
+        return
+
+    entries = []
+    for name in names:
+        path = os.path.join(snapshot_dir, name)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            continue
+        # Files left behind by an older SNAPSHOT_VERSION are evicted first
+        current = name.endswith(SNAPSHOT_SUFFIX)
+        entries.append((current, stat.st_mtime, stat.st_size, path))
+
+    entries.sort()
+    total = sum(size for _, _, size, _ in entries)
+    for current, _, size, path in entries:
+        if total <= max_bytes and current:
+            break
+        _remove_quietly(path)
+        total -= size
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass